@@ -21,7 +21,7 @@ setuptools.setup(
     author="1%Club Developers",
     author_email="devteam@onepercentclub.com",
     install_requires=[
-        'Django>=1.6.8',
+        'Django>=1.9',
         'pycrypto>=2.6.1',
         'python-saml==2.1.7'
     ],
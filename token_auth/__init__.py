@@ -1,5 +1,7 @@
 VERSION = (0, 3, 10, 'final')
 
+default_app_config = 'token_auth.apps.TokenAuthAppConfig'
+
 
 def get_version():
     version = '%s.%s' % (VERSION[0], VERSION[1])
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from token_auth.models import CheckedToken
+from token_auth.models import CheckedToken, LoginAuditEvent, Tenant
 
 
 class LoginTokenAdmin(admin.ModelAdmin):
@@ -13,3 +13,23 @@ class LoginTokenAdmin(admin.ModelAdmin):
 
 
 admin.site.register(CheckedToken, LoginTokenAdmin)
+
+
+class LoginAuditEventAdmin(admin.ModelAdmin):
+
+    list_display = ('timestamp', 'remote_id', 'backend', 'outcome', 'error_code', 'latency', 'client_ip')
+    list_filter = ('outcome', 'backend', 'error_code')
+    search_fields = ('remote_id', 'client_ip')
+
+
+admin.site.register(LoginAuditEvent, LoginAuditEventAdmin)
+
+
+class TenantAdmin(admin.ModelAdmin):
+
+    list_display = ('name', 'is_active', 'modified')
+    list_filter = ('is_active', )
+    search_fields = ('name', )
+
+
+admin.site.register(Tenant, TenantAdmin)
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class TokenAuthAppConfig(AppConfig):
+    name = 'token_auth'
+    verbose_name = 'Token authentication'
+
+    def ready(self):
+        from token_auth.auth.saml import start_validation_pool
+
+        # Fork the validation processes now, before the server starts threads
+        start_validation_pool()
@@ -0,0 +1,151 @@
+import json
+import logging
+import threading
+from Queue import Empty, Full, Queue
+from timeit import default_timer
+
+from django.db import connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from token_auth.models import LoginAuditEvent
+from token_auth.utils import Counters
+
+logger = logging.getLogger(__name__)
+
+
+class JSONLinesSink(object):
+    """
+    Append audit events as JSON lines to the file set with `audit_file`.
+    """
+    def __init__(self, settings):
+        self.path = settings['audit_file']
+
+    def write(self, events):
+        with open(self.path, 'a') as audit_file:
+            for event in events:
+                audit_file.write(json.dumps(dict(event, timestamp=event['timestamp'].isoformat())) + '\n')
+
+
+class ModelSink(object):
+    """
+    Store audit events as `LoginAuditEvent` rows, one insert per batch.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+
+    def write(self, events):
+        LoginAuditEvent.objects.bulk_create([LoginAuditEvent(**event) for event in events])
+
+
+class AuditLog(object):
+    """
+    Buffer audit events in a bounded queue and write them to `sink` in
+    batches from a background thread, so logins never wait for the sink.
+
+    When the buffer is full events are dropped (and counted) instead of
+    blocking the login. The thread stops after `idle_timeout` seconds
+    without events, and is started again by the next event.
+    """
+    def __init__(self, sink, buffer_size=10000, batch_size=100, idle_timeout=1):
+        self.sink = sink
+        self.queue = Queue(buffer_size)
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.counters = Counters()
+
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def emit(self, **event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.counters.incr('dropped')
+            return
+
+        with self._lock:
+            if self._thread is None:
+                # Not a daemon thread, so buffered events are written on exit
+                self._thread = threading.Thread(target=self._run, name='token-auth-audit')
+                self._thread.start()
+
+    def flush(self):
+        """
+        Wait until all buffered events are written.
+        """
+        self.queue.join()
+
+    def _get_batch(self):
+        events = [self.queue.get(timeout=self.idle_timeout)]
+        while len(events) < self.batch_size:
+            try:
+                events.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return events
+
+    def _write(self, events):
+        try:
+            self.sink.write(events)
+            self.counters.incr('written', len(events))
+        except Exception:
+            logger.exception('Could not write {} audit events'.format(len(events)))
+            self.counters.incr('failed', len(events))
+        finally:
+            for _event in events:
+                self.queue.task_done()
+
+    def _run(self):
+        while True:
+            try:
+                events = self._get_batch()
+            except Empty:
+                with self._lock:
+                    if self.queue.empty():
+                        self._thread = None
+                        # Close the database connections of this thread
+                        connections.close_all()
+                        return
+                continue
+
+            self._write(events)
+
+
+def get_audit_log(config):
+    """
+    Return the AuditLog for the `audit_sink` setting, or None if it is not set.
+    """
+    def create():
+        settings = config.settings
+        if not settings.get('audit_sink'):
+            return None
+
+        return AuditLog(
+            import_string(settings['audit_sink'])(settings),
+            buffer_size=settings.get('audit_buffer_size', 10000),
+            batch_size=settings.get('audit_batch_size', 100)
+        )
+
+    return config.get_or_set('audit_log', create)
+
+
+def audit_login(config, request, start, user=None, created=False, error=None):
+    """
+    Emit the audit event for a login attempt that started at `start`
+    (a `timeit.default_timer()` value).
+    """
+    audit_log = get_audit_log(config.root)
+    if audit_log is None:
+        return
+
+    audit_log.emit(
+        timestamp=timezone.now(),
+        backend=config.backend_class.__name__,
+        remote_id=getattr(user, 'remote_id', None),
+        created=created,
+        outcome='error' if error else 'success',
+        error_code=getattr(error, 'code', 'exception') if error else None,
+        latency=(default_timer() - start) * 1000,
+        client_ip=request.META.get('REMOTE_ADDR'),
+    )
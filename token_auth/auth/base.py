@@ -1,21 +1,47 @@
+import hashlib
 import logging
+import time
+from collections import namedtuple
 
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
 
-from token_auth.utils import get_settings
+from token_auth.deferred import get_deferred_writes
+from token_auth.metrics import measure_stage
+from token_auth.utils import get_config
 
 logger = logging.getLogger(__name__)
 
+Metadata = namedtuple('Metadata', ('content', 'etag', 'last_modified'))
+
+# Fields that are always set, whatever the `user_fields` setting, as logins depend on them
+REQUIRED_USER_FIELDS = ('remote_id', 'is_active')
+
+
+def get_changes(user, user_data):
+    """
+    Return the items of `user_data` that differ from the values on `user`.
+    """
+    return dict(
+        (key, value) for key, value in user_data.items() if getattr(user, key) != value
+    )
+
+
+def update_user(user_model, pk, changes):
+    user_model.objects.filter(pk=pk).update(**changes)
+
 
 class BaseTokenAuthentication(object):
     """
     Base class for TokenAuthentication.
     """
-    def __init__(self, request, **kwargs):
+    def __init__(self, request, config=None, **kwargs):
         self.args = kwargs
         self.request = request
 
-        self.settings = get_settings()
+        self.config = config or get_config()
+        self.settings = self.config.settings
 
     def sso_url(self, target_url=None):
         raise NotImplementedError()
@@ -34,34 +60,89 @@ class BaseTokenAuthentication(object):
         """
         raise NotImplementedError()
 
+    def get_user_fields(self):
+        """
+        Return the names of the user fields that can be set from the SSO data.
+
+        These are the concrete fields of the user model, limited to the
+        `user_fields` setting (and `REQUIRED_USER_FIELDS`) if it is set.
+        Computed once per user model.
+        """
+        user_model = get_user_model()
+
+        def get_fields():
+            fields = set()
+            for field in user_model._meta.concrete_fields:
+                if not field.auto_created:
+                    fields.update((field.name, field.attname))
+
+            if 'user_fields' in self.settings:
+                fields.intersection_update(tuple(self.settings['user_fields']) + REQUIRED_USER_FIELDS)
+
+            return frozenset(fields)
+
+        return self.config.get_or_set(('user_fields', user_model), get_fields)
+
     def get_user_data(self, data):
         """
         Set al user data that we got from the SSO service and store it
-        on the user.
+        on the user. Keys can be renamed with the `user_field_mapping` setting.
         """
-        user_model = get_user_model()()
-        return dict([(key, value) for key, value in data.items() if hasattr(user_model, key)])
+        fields = self.get_user_fields()
+        mapping = self.settings.get('user_field_mapping', {})
+
+        user_data = {}
+        for key, value in data.items():
+            key = mapping.get(key, key)
+            if key in fields:
+                user_data[key] = value
+        return user_data
+
+    def get_user(self, remote_id):
+        """
+        Get the user with `remote_id` and lock it for the current transaction.
+        Fall back to a case insensitive match, which can not use an index.
+        """
+        users = get_user_model().objects.select_for_update()
+        try:
+            return users.get(remote_id=remote_id)
+        except ObjectDoesNotExist:
+            return users.filter(remote_id__iexact=remote_id).first()
 
     def get_or_create_user(self, data):
         """
-        Get or create the user.
+        Get or create the user, and store the data from the SSO service on it.
+        The user is only saved if that data changed, in the background if the
+        `deferred_writes` setting is set.
         """
         user_data = self.get_user_data(data)
         user_model = get_user_model()
-        created = False
-        try:
-            user = user_model.objects.get(remote_id=data['remote_id'])
-        except user_model.DoesNotExist:
-            try:
-                user = user_model.objects.get(remote_id__iexact=data['remote_id'])
-                user.remote_id = data['remote_id']
-                user.save()
-            except user_model.DoesNotExist:
-                user = user_model.objects.create(**user_data)
-                created = True
-        user_model.objects.filter(remote_id=data['remote_id']).update(**user_data)
-        user.refresh_from_db()
-        return user, created
+
+        with transaction.atomic():
+            user = self.get_user(data['remote_id'])
+
+            if user is None:
+                try:
+                    with transaction.atomic():
+                        return user_model.objects.create(**user_data), True
+                except IntegrityError:
+                    # The user was created by a concurrent login
+                    user = self.get_user(data['remote_id'])
+                    if user is None:
+                        raise
+
+            changes = get_changes(user, user_data)
+            if changes:
+                for key, value in changes.items():
+                    setattr(user, key, value)
+
+                deferred_writes = get_deferred_writes(self.config.root)
+                if deferred_writes:
+                    deferred_writes.submit(update_user, user_model, user.pk, changes)
+                else:
+                    user.save(update_fields=changes.keys())
+
+        return user, False
 
     def finalize(self, user, data):
         """
@@ -79,11 +160,26 @@ class BaseTokenAuthentication(object):
     def get_metadata(self):
         raise NotImplementedError()
 
-    def authenticate(self):
-        data = self.authenticate_request()
-        data['is_active'] = True
+    def get_cached_metadata(self):
+        """
+        Return the metadata as a `Metadata` tuple, with an etag and the time
+        it was generated. It is only generated again when the settings change.
+        """
+        def generate():
+            content = self.get_metadata()
+            return Metadata(content, hashlib.sha1(content).hexdigest(), int(time.time()))
 
-        user, created = self.get_or_create_user(data)
-        self.finalize(user, data)
+        return self.config.get_or_set(('metadata', self.__class__), generate)
+
+    def authenticate(self):
+        with measure_stage(self, 'authenticate'):
+            with measure_stage(self, 'authenticate_request'):
+                data = self.authenticate_request()
+            data['is_active'] = True
+
+            with measure_stage(self, 'get_or_create_user'):
+                user, created = self.get_or_create_user(data)
+            with measure_stage(self, 'finalize'):
+                self.finalize(user, data)
 
         return user, created
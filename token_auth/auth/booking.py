@@ -2,26 +2,62 @@ import base64
 import hashlib
 import hmac
 import logging
+import os
 import re
 import urllib
+from collections import namedtuple
 from datetime import timedelta
 import string
+import time
 from datetime import datetime
+from itertools import islice
 
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.dateparse import parse_datetime
 from django.utils import timezone
 from Crypto import Random
 from Crypto.Cipher import AES
 
-from token_auth.models import CheckedToken
 from token_auth.auth.base import BaseTokenAuthentication
 from token_auth.exceptions import TokenAuthenticationError
-from token_auth.utils import get_settings
+from token_auth.utils import Counters, get_config
 
 logger = logging.getLogger(__name__)
 
 
-def _encode_message(message):
+class KeyMaterial(object):
+    """
+    The AES and HMAC keys from the settings, validated and prepared once so
+    that encoding and decoding tokens does not need to look them up again.
+    """
+    def __init__(self, settings):
+        self.aes_key = str(settings['aes_key'])
+        if len(self.aes_key) not in AES.key_size:
+            raise ImproperlyConfigured('aes_key should be 16, 24 or 32 bytes long')
+
+        hmac_key = str(settings['hmac_key'])
+        if not hmac_key:
+            raise ImproperlyConfigured('hmac_key should not be empty')
+        self._hmac = hmac.new(hmac_key, digestmod=hashlib.sha1)
+
+    def sign(self, data):
+        """
+        Return the HMAC-SHA1 hash object for `data`.
+        """
+        signature = self._hmac.copy()
+        signature.update(data)
+        return signature
+
+    def cipher(self, init_vector):
+        return AES.new(self.aes_key, AES.MODE_CBC, init_vector)
+
+
+def get_key_material(config=None):
+    config = config or get_config()
+    return config.get_or_set('key_material', lambda: KeyMaterial(config.settings))
+
+
+def _encode_message(message, keys=None, init_vector=None):
     """
     Helper method which returns an encoded version of the
     message passed as an argument.
@@ -30,29 +66,94 @@ def _encode_message(message):
     encrypted message.
     2. The HMAC-SHA1 hash of that string.
     """
-    aes_key = get_settings()['aes_key']
-    hmac_key = get_settings()['hmac_key']
+    keys = keys or get_key_material()
 
     pad = lambda s: s + (AES.block_size - len(s) % AES.block_size) * chr(
         AES.block_size - len(s) % AES.block_size)
-    init_vector = Random.new().read(AES.block_size)
-    cipher = AES.new(aes_key, AES.MODE_CBC, init_vector)
+    init_vector = init_vector or Random.new().read(AES.block_size)
+    cipher = keys.cipher(init_vector)
     padded_message = pad(message)
     aes_message = init_vector + cipher.encrypt(padded_message)
-    hmac_digest = hmac.new(str(hmac_key), str(aes_message), hashlib.sha1)
+    hmac_digest = keys.sign(str(aes_message))
 
     return aes_message, hmac_digest
 
 
-def generate_token(email, username, first_name, last_name):
+LOGIN_DATA_PATTERN = re.compile(r'time=(.*?)\|username=(.*?)\|name=(.*?)\|email=(.*)')
+
+TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_=-]+$')
+
+MAX_TOKEN_LENGTH = 4096
+
+LoginData = namedtuple('LoginData', ('timestamp', 'username', 'name', 'email'))
+
+NON_PRINTABLE = ''.join(chr(char) for char in range(256) if chr(char) not in string.printable)
+
+
+def unpad(message):
+    """
+    Strip the PKCS#7 padding from a decrypted message. Messages that are not
+    padded correctly are returned as is.
+    """
+    length = ord(message[-1]) if message else 0
+    if 0 < length <= AES.block_size and message.endswith(message[-1] * length):
+        return message[:-length]
+    return message
+
+
+def parse_login_data(message):
+    """
+    Parse a decrypted `time=|username=|name=|email=` message. Returns a
+    `LoginData` tuple, or None if the message does not contain login data.
+    """
+    match = LOGIN_DATA_PATTERN.search(unpad(message))
+    if match:
+        return LoginData._make(match.groups())
+
+
+def _get_message(email, username, first_name, last_name):
+    # The message is a byte string, so unicode fields (like from a CSV or JSON file) are sent as UTF-8
+    email, username, first_name, last_name = (
+        value.encode('utf-8') if isinstance(value, unicode) else value
+        for value in (email, username, first_name, last_name)
+    )
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    message = 'time={0}|username={1}|name={2} {3}|' \
-              'email={4}'.format(timestamp, username, first_name, last_name, email)
+    return 'time={0}|username={1}|name={2} {3}|' \
+           'email={4}'.format(timestamp, username, first_name, last_name, email)
+
+
+def generate_token(email, username, first_name, last_name):
+    message = _get_message(email, username, first_name, last_name)
     aes_message, hmac_digest = _encode_message(message)
     token = base64.urlsafe_b64encode(aes_message + hmac_digest.digest())
     return token
 
 
+def generate_tokens(records, chunk_size=1000):
+    """
+    Generate tokens for an iterable of (email, username, first_name,
+    last_name) tuples. The tokens are generated lazily, in order.
+
+    The initialization vectors are read from os.urandom for `chunk_size`
+    tokens at a time.
+    """
+    keys = get_key_material()
+    records = iter(records)
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+
+        init_vectors = os.urandom(AES.block_size * len(chunk))
+        for index, (email, username, first_name, last_name) in enumerate(chunk):
+            init_vector = init_vectors[index * AES.block_size:(index + 1) * AES.block_size]
+            aes_message, hmac_digest = _encode_message(
+                _get_message(email, username, first_name, last_name), keys=keys, init_vector=init_vector
+            )
+            yield base64.urlsafe_b64encode(aes_message + hmac_digest.digest())
+
+
 class TokenAuthentication(BaseTokenAuthentication):
     """
     This authentication backend expects a token, encoded in URL-safe Base64, to
@@ -66,29 +167,61 @@ class TokenAuthentication(BaseTokenAuthentication):
     the encrypted message to be read.
 
     The backend performs the next operations over a received token in order to
-    authenticate the user who is sending it:
-
-    1. Checks that the token was not used previously, to prevent replay.
-    2. Decodes it through Base64.
-    3. Checks the HMAC-SHA1 signature of the message.
-    4. Decrypts the AES-encoded message to read the data.
-    5. Read the timestamp included in the message to check if the token already
+    authenticate the user who is sending it, cheapest first, so that invalid
+    tokens are rejected before the used-token store is queried:
+
+    1. Checks the length and characters of the token and decodes it through
+    Base64.
+    2. Checks the HMAC-SHA1 signature of the message (in constant time).
+    3. Decrypts the AES-encoded message to read the data.
+    4. Read the timestamp included in the message to check if the token already
     expired or if its finally valid.
+    5. Checks that the token was not used previously, to prevent replay.
+
+    The number of rejected tokens per reason is counted in `rejections`.
     """
+    rejections = Counters()
+
+    @property
+    def keys(self):
+        return get_key_material(self.config)
+
+    def decode_token(self):
+        """
+        Checks the shape of the token and decodes it through Base64.
+        """
+        token = self.args.get('token')
+        if not token:
+            raise TokenAuthenticationError(value='No token provided', code='no_token')
+
+        if len(token) > MAX_TOKEN_LENGTH or not TOKEN_PATTERN.match(token):
+            raise TokenAuthenticationError('Malformed token', code='malformed')
+
+        try:
+            message = base64.urlsafe_b64decode(str(token))
+        except TypeError:
+            raise TokenAuthenticationError('Malformed token', code='malformed')
+
+        # Initialization vector, at least one AES block and the signature
+        if len(message) < 2 * AES.block_size + 20 or (len(message) - 20) % AES.block_size:
+            raise TokenAuthenticationError('Malformed token', code='malformed')
+
+        return message
+
     def check_hmac_signature(self, message):
         """
         Checks the HMAC-SHA1 signature of the message.
         """
         data = message[:-20]
         checksum = message[-20:]
-        hmac_data = hmac.new(str(self.settings['hmac_key']), str(data), hashlib.sha1)
+        hmac_data = self.keys.sign(str(data))
 
-        return True if hmac_data.digest() == checksum else False
+        return hmac.compare_digest(hmac_data.digest(), checksum)
 
     def get_login_data(self, data):
         """
-        Obtains the data from the decoded message. Returns a Python tuple
-        of 4 elements containing the login data. The elements, from zero
+        Obtains the data from the decoded message. Returns a `LoginData`
+        tuple of 4 elements containing the login data. The elements, from zero
         to three, are:
 
         0. Timestamp.
@@ -96,64 +229,57 @@ class TokenAuthentication(BaseTokenAuthentication):
         2. Complete name.
         3. Email.
         """
-        expression = r'(.*?)\|'
-        pattern = r'time={0}username={0}name={0}email=(.*)'.format(expression)
-        login_data = re.search(pattern, data)
+        login_data = parse_login_data(data)
+        if login_data is None:
+            raise TokenAuthenticationError('Message does not contain valid login data', code='invalid_data')
 
-        return login_data.groups()
+        return login_data
 
     def check_timestamp(self, data):
         timestamp = datetime.strptime(data['timestamp'], '%Y-%m-%d %H:%M:%S')
         time_limit = datetime.now() - \
             timedelta(seconds=self.settings['token_expiration'])
         if timestamp < time_limit:
-            raise TokenAuthenticationError('Authentication token expired')
+            raise TokenAuthenticationError('Authentication token expired', code='expired')
+
+    def get_expires(self, data):
+        """
+        Return the time (in seconds since the epoch) the token expires.
+        """
+        timestamp = datetime.strptime(data['timestamp'], '%Y-%m-%d %H:%M:%S')
+        return time.mktime(timestamp.timetuple()) + self.settings['token_expiration']
 
     def check_token_used(self):
         if not self.args.get('token'):
-            raise TokenAuthenticationError(value='No token provided')
-        try:
-            CheckedToken.objects.get(token=self.args['token'])
+            raise TokenAuthenticationError(value='No token provided', code='no_token')
+        if self.config.token_store.is_used(self.args['token']):
             raise TokenAuthenticationError(
-                value='Token was already used and is not valid')
-        except CheckedToken.DoesNotExist:
-            # Token was not used previously. Continue with auth process.
-            pass
+                value='Token was already used and is not valid', code='used')
 
     def decrypt_message(self):
         """
         Decrypts the AES encoded message.
         """
-        token = str(self.args['token'])
-        message = base64.urlsafe_b64decode(token)
+        message = self.decode_token()
 
         # Check that the message is valid (HMAC-SHA1 checking).
         if not self.check_hmac_signature(message):
-            raise TokenAuthenticationError('HMAC authentication failed')
+            raise TokenAuthenticationError('HMAC authentication failed', code='hmac')
 
         init_vector = message[:16]
         enc_message = message[16:-20]
 
-        aes = AES.new(self.settings['aes_key'], AES.MODE_CBC, init_vector)
+        aes = self.keys.cipher(init_vector)
         message = aes.decrypt(enc_message)
 
         # Get the login data in an easy-to-use tuple.
-        try:
-            login_data = self.get_login_data(message)
-        except AttributeError:
-            # Regex failed, so data was not valid.
-            raise TokenAuthenticationError('Message does not contain valid login data')
-
-        name = login_data[2].strip()
-        first_name = name.split(' ').pop(0)
-        parts = name.split(' ')
-        parts.pop(0)
-        last_name = " ".join(parts)
-        email = login_data[3].strip()
-        email = filter(lambda x: x in string.printable, email)
+        login_data = self.get_login_data(message)
+
+        first_name, _, last_name = login_data.name.strip().partition(' ')
+        email = login_data.email.strip().translate(None, NON_PRINTABLE)
 
         data = {
-            'timestamp': login_data[0],
+            'timestamp': login_data.timestamp,
             'remote_id': email,
             'email': email,
             'first_name': first_name,
@@ -175,14 +301,22 @@ class TokenAuthentication(BaseTokenAuthentication):
         return url
 
     def authenticate_request(self):
-        self.check_token_used()
-        data = self.decrypt_message()
-        self.check_timestamp(data)
+        try:
+            data = self.decrypt_message()
+            self.check_timestamp(data)
+            self.check_token_used()
+        except TokenAuthenticationError, e:
+            self.rejections.incr(e.code)
+            if e.code == 'used':
+                e.expires = self.get_expires(data)
+            raise
 
         return data
 
     def finalize(self, user, data):
         timestamp = timezone.make_aware(parse_datetime(data['timestamp']))
 
-        CheckedToken.objects.create(token=self.args['token'], user=user,
-                                    timestamp=timestamp).save()
+        if not self.config.token_store.mark_used(self.args['token'], user, timestamp):
+            self.rejections.incr('used')
+            raise TokenAuthenticationError(
+                value='Token was already used and is not valid', code='used', expires=self.get_expires(data))
@@ -1,21 +1,123 @@
+import base64
+import binascii
 import logging
+import os
+import re
+import threading
+import time
+from multiprocessing import Pool, TimeoutError
 
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from onelogin.saml2.auth import OneLogin_Saml2_Auth
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
 from onelogin.saml2.errors import OneLogin_Saml2_Error
+from onelogin.saml2.response import OneLogin_Saml2_Response
 from onelogin.saml2.settings import OneLogin_Saml2_Settings
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
 
+from token_auth.caches import LRUCache
 from token_auth.exceptions import TokenAuthenticationError
 from token_auth.auth.base import BaseTokenAuthentication
+from token_auth.idp_metadata import get_idp_settings
+from token_auth.metrics import measure_stage
+from token_auth.stores import get_assertion_store
+from token_auth.utils import Counters, get_config
 
 
 logger = logging.getLogger(__name__)
 
+# Parsed settings of the most recently used configurations (like tenants)
+_saml_settings = LRUCache(256)
+_saml_settings_lock = threading.Lock()
 
-def get_saml_request(request):
+
+def _get_parsed(key, parse):
+    parsed = _saml_settings.get(key)
+    if parsed is not None:
+        return parsed
+
+    with _saml_settings_lock:
+        parsed = _saml_settings.get(key)
+        if parsed is None:
+            parsed = parse()
+            _saml_settings.set(key, parsed)
+        return parsed
+
+
+def _get_saml_settings(settings_hash, settings, sp_validation_only=False):
+    def parse():
+        base_path = settings.get('base_path', None) if sp_validation_only else None
+        return OneLogin_Saml2_Settings(settings=settings,
+                                       custom_base_path=base_path,
+                                       sp_validation_only=sp_validation_only)
+
+    return _get_parsed((settings_hash, sp_validation_only), parse)
+
+
+def _get_rollover_settings(settings_hash, settings):
+    """
+    Return parsed settings for each IdP signing certificate in
+    `x509certMulti` other than `x509cert`, to check signatures with while the
+    IdP rolls over to a new certificate.
+    """
+    def parse():
+        idp = settings.get('idp', {})
+        current = OneLogin_Saml2_Utils.format_cert(idp.get('x509cert') or '')
+        return [
+            OneLogin_Saml2_Settings(settings=dict(settings, idp=dict(idp, x509cert=cert)))
+            for cert in idp.get('x509certMulti', {}).get('signing', [])
+            if OneLogin_Saml2_Utils.format_cert(cert) != current
+        ]
+
+    return _get_parsed((settings_hash, 'rollover'), parse)
+
+
+def get_saml_settings(config, sp_validation_only=False):
+    """
+    Return the parsed and validated OneLogin_Saml2_Settings for the config,
+    with the IdP settings from its metadata if `idp_metadata` is set.
+
+    Parsing the settings (and the certificates in them) is expensive, so they
+    are parsed once and shared, keyed on a hash of the settings.
+    """
+    if sp_validation_only:
+        return _get_saml_settings(config.settings_hash, config.settings, sp_validation_only)
+    return _get_saml_settings(*get_idp_settings(config))
+
+
+@receiver(setting_changed)
+def _clear_saml_settings(sender, setting, **kwargs):
+    if setting in ('TOKEN_AUTH', 'TOKEN_AUTH_SETTINGS'):
+        _saml_settings.clear()
+
+
+def is_from_proxy(request, trusted_proxies=None):
+    """
+    Whether the request came through a proxy whose X-Forwarded headers can be
+    trusted: one of the `trusted_proxies` addresses (or any, with '*'). Without
+    `trusted_proxies` any request with an X-Forwarded-For header is trusted.
+    """
+    if trusted_proxies is None:
+        return 'HTTP_X_FORWARDED_FOR' in request.META
+
+    return '*' in trusted_proxies or request.META.get('REMOTE_ADDR') in trusted_proxies
+
+
+def get_saml_request(request, trusted_proxies=None):
+    """
+    Return the request data for OneLogin_Saml2_Auth. The GET and POST data
+    are the (read-only) QueryDicts of the request, not copies, as the
+    SAMLResponse in them can be large.
+    """
     http_host = request.META.get('HTTP_HOST', None)
-    if 'HTTP_X_FORWARDED_FOR' in request.META:
-        server_port = None
-        https = request.META.get('HTTP_X_FORWARDED_PROTO') == 'https'
+    if is_from_proxy(request, trusted_proxies):
+        server_port = request.META.get('HTTP_X_FORWARDED_PORT')
+        if 'HTTP_X_FORWARDED_PROTO' in request.META:
+            https = request.META['HTTP_X_FORWARDED_PROTO'] == 'https'
+        else:
+            https = request.is_secure()
     else:
         server_port = request.META.get('SERVER_PORT')
         https = request.is_secure()
@@ -24,8 +126,8 @@ def get_saml_request(request):
         'https': 'on' if https else 'off',
         'http_host': http_host,
         'script_name': request.META['PATH_INFO'],
-        'get_data': request.GET.copy() or request.POST.copy(),
-        'post_data': request.POST.copy()
+        'get_data': request.GET or request.POST,
+        'post_data': request.POST
     }
 
     if server_port:
@@ -34,11 +136,397 @@ def get_saml_request(request):
     return saml_request
 
 
+# Size of the encoded chunks a SAMLResponse is decoded in, a multiple of 4
+DECODE_CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'\s+')
+NON_BASE64 = re.compile(r'[^A-Za-z0-9+/=]')
+SPACE = re.compile(r'\s*')
+XML_DECLARATION = re.compile(r'<\?xml[^>]*\?>')
+# A (samlp:)Response root element, see `match_root`
+RESPONSE_ROOT = re.compile(r'<([\w.-]+:)?Response(?P<attributes>[\s/>][^>]*)')
+RESPONSE_ID = re.compile(r'\sID="([^"]+)"')
+RESPONSE_HEAD_SIZE = 4096
+SIGNATURE_NAMESPACE = 'http://www.w3.org/2000/09/xmldsig#'
+# The error of OneLogin_Saml2_Response when the signature does not match the certificate
+SIGNATURE_FAILED = 'Signature validation failed. SAML Response rejected'
+
+
+def decode_chunks(encoded, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Decode base64 data in chunks, so it never has to be decoded completely
+    in memory. Raises TypeError if it is not valid base64.
+    """
+    rest = ''
+    for start in xrange(0, len(encoded), chunk_size):
+        data = rest + WHITESPACE.sub('', encoded[start:start + chunk_size]).encode('ascii')
+        if NON_BASE64.search(data):
+            raise TypeError('Invalid base64 character')
+
+        end = len(data) - len(data) % 4
+        yield base64.b64decode(data[:end])
+        rest = data[end:]
+
+    if rest:
+        raise TypeError('Incomplete base64 data')
+
+
+def match_root(head):
+    """
+    Match the (samlp:)Response root element, optionally after an XML
+    declaration and comments. Anything else (like a DOCTYPE) is rejected.
+
+    The comments are skipped with a linear scan: a regular expression for
+    them backtracks exponentially on many comments without a Response.
+    """
+    position = SPACE.match(head).end()
+    declaration = XML_DECLARATION.match(head, position)
+    if declaration:
+        position = SPACE.match(head, declaration.end()).end()
+
+    while head.startswith('<!--', position):
+        end = head.find('-->', position + 4)
+        if end == -1:
+            return None
+        position = SPACE.match(head, end + 3).end()
+
+    return RESPONSE_ROOT.match(head, position)
+
+
+def check_saml_response(encoded, max_size=1024 * 1024, max_decoded_size=1024 * 1024):
+    """
+    Cheap checks of an (encoded) SAMLResponse before it is parsed: the size
+    (before and after decoding), the root element and whether it contains a
+    signature at all. Raises a TokenAuthenticationError with code
+    `too_large`, `malformed`, `wrong_root` or `unsigned`.
+
+    Returns the (unverified) ID of the response, if it has one.
+    """
+    if len(encoded) > max_size:
+        raise TokenAuthenticationError('SAML response too large', code='too_large')
+
+    decoded_size = 0
+    head = tail = ''
+    signed = False
+    try:
+        for chunk in decode_chunks(encoded):
+            decoded_size += len(chunk)
+            if decoded_size > max_decoded_size:
+                raise TokenAuthenticationError('SAML response too large', code='too_large')
+
+            if len(head) < RESPONSE_HEAD_SIZE:
+                head += chunk[:RESPONSE_HEAD_SIZE - len(head)]
+
+            # Keep the end of the chunk, for a namespace split over two chunks
+            signed = signed or SIGNATURE_NAMESPACE in tail + chunk
+            tail = chunk[-len(SIGNATURE_NAMESPACE):]
+    except (TypeError, binascii.Error, UnicodeError):
+        raise TokenAuthenticationError('SAML response is not valid base64', code='malformed')
+
+    root = match_root(head)
+    if not root:
+        raise TokenAuthenticationError('SAML response is not a Response', code='wrong_root')
+
+    if not signed:
+        raise TokenAuthenticationError('SAML response is not signed', code='unsigned')
+
+    response_id = RESPONSE_ID.search(root.group('attributes'))
+    return response_id.group(1) if response_id else None
+
+
+def query_assertion(response, query):
+    """
+    Query the (signed) assertion of a validated response.
+    """
+    return response._OneLogin_Saml2_Response__query_assertion(query)
+
+
+def get_replay_ids(response):
+    """
+    Return the IDs of a validated response and its assertion. A replayed
+    assertion can come in a new (unsigned) response, so both are checked.
+    """
+    ids = [response.document.get('ID')]
+    ids.extend(assertion.get('ID') for assertion in query_assertion(response, ''))
+    return [saml_id for saml_id in ids if saml_id]
+
+
+def get_expires(response):
+    """
+    Return the time (as a timestamp) after which the assertion of a validated
+    response is no longer accepted, or None if it does not expire.
+    """
+    limits = [
+        OneLogin_Saml2_Utils.parse_SAML_to_time(node.get('NotOnOrAfter'))
+        for node in query_assertion(response, '/saml:Conditions[@NotOnOrAfter]') + query_assertion(
+            response, '/saml:Subject/saml:SubjectConfirmation/saml:SubjectConfirmationData[@NotOnOrAfter]'
+        )
+    ]
+    return min(limits) + OneLogin_Saml2_Constants.ALLOWED_CLOCK_DRIFT if limits else None
+
+
+def get_picklable_request(request_data):
+    """
+    Return the request data with the QueryDicts replaced by plain dicts.
+    """
+    return dict(request_data, get_data=dict(request_data['get_data'].items()),
+                post_data=dict(request_data['post_data'].items()))
+
+
+class SAMLAuth(OneLogin_Saml2_Auth):
+    """
+    OneLogin_Saml2_Auth that uses already parsed settings.
+
+    OneLogin_Saml2_Auth always parses the settings itself, so instead of
+    calling its __init__ we set up the same (private) state here. Responses
+    that fail the signature check are checked again with each of the
+    `rollover_settings`, see `_get_rollover_settings`.
+    """
+    # The state set by process_response()
+    response_state = ('attributes', 'nameid', 'session_index', 'session_expiration', 'authenticated',
+                      'errors', 'error_reason', 'last_request_id', 'replay_ids', 'expires')
+    # The part of that state that is not from OneLogin_Saml2_Auth
+    own_state = ('replay_ids', 'expires')
+
+    def __init__(self, request_data, saml_settings, rollover_settings=()):
+        self.rollover_settings = rollover_settings
+        state = {
+            'request_data': request_data,
+            'settings': saml_settings,
+            'attributes': [],
+            'nameid': None,
+            'session_index': None,
+            'session_expiration': None,
+            'authenticated': False,
+            'errors': [],
+            'error_reason': None,
+            'last_request_id': None,
+            'replay_ids': [],
+            'expires': None,
+        }
+        self.set_state(state)
+
+    def get_attribute_name(self, name):
+        return name if name in self.own_state else '_OneLogin_Saml2_Auth__' + name
+
+    def get_state(self):
+        """
+        Return the outcome of processing a response, see `set_state`.
+        """
+        return dict(
+            (name, getattr(self, self.get_attribute_name(name))) for name in self.response_state
+        )
+
+    def set_state(self, state):
+        for name, value in state.items():
+            setattr(self, self.get_attribute_name(name), value)
+
+    def process_response(self, request_id=None):
+        """
+        Same as OneLogin_Saml2_Auth.process_response, but also keeps the IDs
+        of the valid response and assertion (`replay_ids`) and the time they
+        expire (`expires`), to prevent replays.
+        """
+        post_data = self.__request_data['post_data']
+        if 'SAMLResponse' not in post_data:
+            return super(SAMLAuth, self).process_response(request_id)
+
+        self.set_state({'errors': []})
+        for saml_settings in [self.get_settings()] + list(self.rollover_settings):
+            response = OneLogin_Saml2_Response(saml_settings, post_data['SAMLResponse'])
+
+            if response.is_valid(self.__request_data, request_id):
+                self.set_state({
+                    'attributes': response.get_attributes(),
+                    'nameid': response.get_nameid(),
+                    'session_index': response.get_session_index(),
+                    'session_expiration': response.get_session_not_on_or_after(),
+                    'authenticated': True,
+                    'replay_ids': get_replay_ids(response),
+                    'expires': get_expires(response),
+                })
+                return
+            elif response.get_error() != SIGNATURE_FAILED:
+                break
+
+        self.set_state({'errors': ['invalid_response'], 'error_reason': response.get_error()})
+
+    @property
+    def __request_data(self):
+        return self._OneLogin_Saml2_Auth__request_data
+
+
+def process_response(request_data, settings_hash, settings):
+    """
+    Validate the SAML response in `request_data` and return the state of the
+    SAMLAuth afterwards, with `exception` set to the error if it failed.
+
+    Runs in the processes of the `ValidationPool`, so all arguments and the
+    result are plain (picklable) data.
+    """
+    auth = SAMLAuth(request_data, _get_saml_settings(settings_hash, settings),
+                    _get_rollover_settings(settings_hash, settings))
+    try:
+        auth.process_response()
+    except OneLogin_Saml2_Error, e:
+        return dict(auth.get_state(), exception=str(e), saml_error=True)
+    except Exception, e:
+        logger.exception('Saml response validation failed')
+        return dict(auth.get_state(), exception=repr(e), saml_error=False)
+    return auth.get_state()
+
+
+class ValidationPool(object):
+    """
+    Process pool to validate SAML responses on all cores, set up with the
+    `saml_validation_processes` setting.
+
+    At most `saml_validation_queue` responses (default four per process) are
+    validated or waiting at the same time; more are rejected right away.
+    Waiting for a result takes at most `saml_validation_timeout` seconds.
+
+    A validation keeps its slot until it finishes, also after it timed out.
+    When its worker dies (for example killed when out of memory) the result
+    never comes, so slots of validations that did not finish in twice the
+    timeout are given back, and the pool is replaced.
+
+    The pool is started when the app is loaded (see `start_validation_pool`)
+    rather than forked from a threaded server in the middle of a request.
+    """
+    def __init__(self, settings):
+        self.processes = settings['saml_validation_processes']
+        self.timeout = settings.get('saml_validation_timeout', 10)
+        self.queue = settings.get('saml_validation_queue', self.processes * 4)
+        self.slots = threading.BoundedSemaphore(self.queue)
+        # Results of the validations holding a slot, with the time they are given up on
+        self.pending = {}
+        self._pool = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def get_pool(self):
+        """
+        Return the process pool, starting it if needed. Call with the lock held.
+        """
+        if self._pid != os.getpid():
+            # The pool (and the validations) of the parent process are of no use after a fork
+            self.pending = {}
+            self.slots = threading.BoundedSemaphore(self.queue)
+            self._pool = None
+            self._pid = os.getpid()
+
+        if self._pool is None:
+            self._pool = Pool(self.processes)
+        return self._pool
+
+    def start(self):
+        with self._lock:
+            self.get_pool()
+
+    def release(self, result):
+        with self._lock:
+            if result in self.pending:
+                del self.pending[result]
+                self.slots.release()
+
+    def release_finished(self):
+        """
+        Give back the slots of finished validations, and of the ones that
+        are given up on. If any are, the pool is replaced: their workers died
+        or are stuck, and the results of the old pool never come.
+        """
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                self.get_pool()
+            lost = [result for result, deadline in self.pending.items() if not result.ready() and deadline < now]
+            for result in self.pending.keys():
+                if lost or result.ready():
+                    del self.pending[result]
+                    self.slots.release()
+
+            if lost and self._pool is not None:
+                logger.error('{} SAML response validations were lost, replacing the pool'.format(len(lost)))
+                self._pool.terminate()
+                self._pool = None
+
+    def process_response(self, request_data, settings_hash, settings):
+        self.release_finished()
+        if not self.slots.acquire(False):
+            raise TokenAuthenticationError('Too many SAML responses to validate, try again later',
+                                           code='saturated')
+
+        try:
+            # Under the lock, so the pool is not replaced in the meantime
+            with self._lock:
+                result = self.get_pool().apply_async(process_response, (request_data, settings_hash, settings))
+                self.pending[result] = time.time() + self.timeout * 2
+        except Exception:
+            self.slots.release()
+            logger.exception('Saml response validation could not be started')
+            raise TokenAuthenticationError('Validating the SAML response failed, try again later')
+
+        try:
+            return result.get(self.timeout)
+        except TimeoutError:
+            raise TokenAuthenticationError('Validating the SAML response timed out', code='timeout')
+        finally:
+            if result.ready():
+                self.release(result)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+def get_validation_pool(config):
+    """
+    Return the ValidationPool for the config, or None if
+    `saml_validation_processes` is not set.
+    """
+    def create():
+        if not config.settings.get('saml_validation_processes'):
+            return None
+        return ValidationPool(config.settings)
+
+    return config.get_or_set('saml_validation_pool', create)
+
+
+def start_validation_pool():
+    """
+    Start the processes of the ValidationPool, if it is set up. Called when
+    the app is loaded, before the server starts handling requests.
+    """
+    try:
+        config = get_config()
+    except ImproperlyConfigured:
+        return
+
+    pool = get_validation_pool(config)
+    if pool is not None:
+        pool.start()
+
+
 class SAMLAuthentication(BaseTokenAuthentication):
+    """
+    Authenticates users with a SAML response, posted by the IdP.
+
+    Responses are checked with `check_saml_response` before they are
+    parsed, and the IDs of valid responses are stored to reject replays. The
+    number of responses rejected by those checks per reason is counted in
+    `rejections`.
+    """
+    rejections = Counters()
 
     def __init__(self, request, **kwargs):
         super(SAMLAuthentication, self).__init__(request, **kwargs)
-        self.auth = OneLogin_Saml2_Auth(get_saml_request(request), self.settings)
+        self.request_data = get_saml_request(request, self.settings.get('trusted_proxies'))
+        # The same IdP settings for the whole request, even if they are refreshed in the meantime
+        self.idp_settings = get_idp_settings(self.config)
+        self.auth = SAMLAuth(self.request_data, _get_saml_settings(*self.idp_settings),
+                             _get_rollover_settings(*self.idp_settings))
 
     def sso_url(self, target_url=None):
         return self.auth.login(return_to=target_url,
@@ -49,10 +537,7 @@ class SAMLAuthentication(BaseTokenAuthentication):
         return self.request.POST.get('RelayState')
 
     def get_metadata(self):
-        base_path = self.settings.get('base_path', None)
-        saml_settings = OneLogin_Saml2_Settings(settings=self.settings,
-                                                custom_base_path=base_path,
-                                                sp_validation_only=True)
+        saml_settings = get_saml_settings(self.config, sp_validation_only=True)
         metadata = saml_settings.get_sp_metadata()
         errors = saml_settings.validate_metadata(metadata)
         if len(errors):
@@ -74,14 +559,72 @@ class SAMLAuthentication(BaseTokenAuthentication):
 
         return data
 
+    def process_response(self):
+        """
+        Validate the SAML response, in the validation pool if it is set up.
+        """
+        pool = get_validation_pool(self.config.root)
+        if pool is None:
+            self.auth.process_response()
+            return
+
+        request_data = get_picklable_request(self.request_data)
+        state = pool.process_response(request_data, *self.idp_settings)
+        exception = state.pop('exception', None)
+        saml_error = state.pop('saml_error', False)
+        self.auth.set_state(state)
+
+        if exception and saml_error:
+            raise OneLogin_Saml2_Error(exception)
+        elif exception:
+            raise TokenAuthenticationError('Validating the SAML response failed: {}'.format(exception))
+
+    def check_response(self):
+        """
+        Reject oversized, obviously invalid and already used responses
+        before parsing them. A missing response is left to `process_response`.
+        """
+        encoded = self.request_data['post_data'].get('SAMLResponse')
+        if encoded is None:
+            return
+
+        try:
+            response_id = check_saml_response(
+                encoded,
+                max_size=self.settings.get('saml_max_response_size', 1024 * 1024),
+                max_decoded_size=self.settings.get('saml_max_decoded_size', 1024 * 1024)
+            )
+            if response_id and get_assertion_store(self.config.root).is_used(response_id):
+                raise TokenAuthenticationError('SAML response was already used', code='replayed')
+        except TokenAuthenticationError, e:
+            logger.error('Saml login error: {}'.format(e.value))
+            self.rejections.incr(e.code)
+            raise
+
+    def mark_used(self):
+        """
+        Store the IDs of the validated response and assertion as used.
+        """
+        store = get_assertion_store(self.config.root)
+        used = [store.mark_used(saml_id, self.auth.expires) for saml_id in self.auth.replay_ids]
+        if not all(used):
+            logger.error('Saml login error: SAML response was already used')
+            self.rejections.incr('replayed')
+            raise TokenAuthenticationError('SAML response was already used', code='replayed')
+
     def authenticate_request(self):
+        self.check_response()
+
         try:
-            self.auth.process_response()
+            with measure_stage(self, 'process_response'):
+                self.process_response()
         except OneLogin_Saml2_Error, e:
             logger.error('Saml login error: {}'.format(e))
             raise TokenAuthenticationError(e)
 
         if self.auth.is_authenticated():
+            self.mark_used()
+
             user_data = self.auth.get_attributes()
             user_data['nameId'] = [self.auth.get_nameid()]
 
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from token_auth.exceptions import TokenAuthenticationError
+from token_auth.models import get_token_hash
+
+
+class LRUCache(object):
+    """
+    Thread safe in-process cache with a maximum size, that evicts the least
+    recently used items first. Items can have a timeout (in seconds).
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _get(self, key):
+        try:
+            value, expires = self._items.pop(key)
+        except KeyError:
+            return False, None
+
+        if expires is not None and expires < time.time():
+            return False, None
+
+        self._items[key] = (value, expires)
+        return True, value
+
+    def _set(self, key, value, timeout):
+        self._items.pop(key, None)
+        self._items[key] = (value, time.time() + timeout if timeout else None)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._get(key)
+        return value if found else default
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        """
+        Set the value only if the key is not cached yet. Returns True if the
+        value was set.
+        """
+        with self._lock:
+            found, _value = self._get(key)
+            if not found:
+                self._set(key, value, timeout)
+            return not found
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class RejectedTokenCache(object):
+    """
+    Remembers why tokens were rejected, so that requests retrying the same
+    (used, expired or forged) token are rejected without checking it again.
+
+    The rejections are kept in an in-process LRU cache of
+    `rejected_token_cache_size` tokens (default 10000, 0 disables it), and
+    optionally in the Django cache set with `rejected_token_cache`.
+
+    Only rejections that are final (`PERMANENT_CODES`) are kept, for
+    `token_expiration` seconds, or until the token expires if that is
+    known: after that, the token is rejected as expired anyway.
+    """
+    key_prefix = 'token_auth:rejected:'
+
+    # Tokens rejected for other reasons (like a saturated server) may be accepted when retried
+    PERMANENT_CODES = frozenset(('malformed', 'hmac', 'invalid_data', 'expired', 'used'))
+
+    def __init__(self, settings):
+        self.timeout = settings.get('token_expiration', 600)
+        self.local = LRUCache(settings.get('rejected_token_cache_size', 10000))
+        self.cache_alias = settings.get('rejected_token_cache')
+
+    @property
+    def enabled(self):
+        return bool(self.local.max_size or self.cache_alias)
+
+    def get_key(self, token):
+        return self.key_prefix + get_token_hash(token)
+
+    def get(self, token):
+        """
+        Return the TokenAuthenticationError the token was rejected with, or
+        None if it was not rejected before.
+        """
+        if not self.enabled:
+            return None
+
+        key = self.get_key(token)
+        rejection = self.local.get(key)
+        if rejection is None and self.cache_alias:
+            rejection = caches[self.cache_alias].get(key)
+            if rejection is not None:
+                self.local.set(key, rejection, self.timeout)
+
+        if rejection is not None:
+            value, code = rejection
+            return TokenAuthenticationError(value, code=code)
+
+    def add(self, token, error):
+        if not self.enabled or error.code not in self.PERMANENT_CODES:
+            return
+
+        timeout = self.timeout
+        if error.expires is not None:
+            timeout = min(timeout, int(error.expires - time.time()))
+            if timeout <= 0:
+                return
+
+        key = self.get_key(token)
+        rejection = (error.value, error.code)
+        self.local.set(key, rejection, timeout)
+        if self.cache_alias:
+            caches[self.cache_alias].set(key, rejection, timeout)
+
+
+def get_rejected_tokens(config):
+    return config.get_or_set('rejected_tokens', lambda: RejectedTokenCache(config.settings))
@@ -0,0 +1,68 @@
+import atexit
+import logging
+import weakref
+from multiprocessing.pool import ThreadPool
+
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# All DeferredWrites, to wait for their queued writes on exit
+_instances = weakref.WeakSet()
+
+
+def run_task(func, args):
+    close_old_connections()
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Deferred write {} failed'.format(func.__name__))
+    finally:
+        close_old_connections()
+
+
+class DeferredWrites(object):
+    """
+    Run writes that are not needed to finish the login (like refreshing the
+    user attributes) in a pool of `threads` background threads.
+
+    Writes are only queued once the current transaction commits, so they
+    are dropped when it is rolled back. The pool threads are daemons, so
+    queued writes are finished by `close_all` when the process exits.
+    """
+    def __init__(self, threads=2):
+        self.pool = ThreadPool(threads)
+        _instances.add(self)
+
+    def submit(self, func, *args):
+        transaction.on_commit(lambda: self.pool.apply_async(run_task, (func, args)))
+
+    def close(self):
+        """
+        Stop accepting writes and wait for the queued ones.
+        """
+        self.pool.close()
+        self.pool.join()
+
+
+@atexit.register
+def close_all():
+    """
+    Wait for the queued writes of all DeferredWrites. Registered after the
+    exit handler of multiprocessing, so it runs before the pools are terminated.
+    """
+    for deferred_writes in list(_instances):
+        deferred_writes.close()
+
+
+def get_deferred_writes(config):
+    """
+    Return the DeferredWrites for the config, or None if the
+    `deferred_writes` setting is not set.
+    """
+    def create():
+        if not config.settings.get('deferred_writes'):
+            return None
+        return DeferredWrites(config.settings.get('deferred_writes_threads', 2))
+
+    return config.get_or_set('deferred_writes', create)
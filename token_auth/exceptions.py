@@ -1,9 +1,29 @@
 class TokenAuthenticationError(Exception):
     """
     There was an error trying to authenticate with token.
+
+    `code` is a short, stable identifier of the reason, for statistics.
+    `expires` is the time (in seconds since the epoch) the token expires,
+    if it is known.
     """
-    def __init__(self, value=None):
+    def __init__(self, value=None, code=None, expires=None):
         self.value = value if value else 'Error trying to authenticate by token'
+        self.code = code or 'error'
+        self.expires = expires
 
     def __str__(self):
         return repr(self.value)
+
+
+class UnknownTenant(Exception):
+    """
+    There are no settings for the requested tenant.
+    """
+    pass
+
+
+class IdPMetadataError(Exception):
+    """
+    The IdP metadata could not be loaded or parsed.
+    """
+    pass
@@ -0,0 +1,300 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib2
+from collections import namedtuple
+
+from defusedxml.lxml import fromstring
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
+from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+from token_auth.exceptions import IdPMetadataError
+from token_auth.utils import get_settings_hash
+
+logger = logging.getLogger(__name__)
+
+# Signing certificates: the ones for signing and the ones without a `use`
+SIGNING_CERTS = "./md:KeyDescriptor[not(@use) or @use='signing']/ds:KeyInfo/ds:X509Data/ds:X509Certificate"
+
+# Minimum seconds between two attempts to load the metadata from the source,
+# so metadata that is expired at the source or a source that is down is not
+# loaded on every request
+RETRY_INTERVAL = 60
+
+MetadataState = namedtuple('MetadataState', ('metadata', 'settings_hash', 'settings'))
+
+
+def get_expires(node):
+    """
+    Return the earliest expiry time (from `validUntil` and `cacheDuration`)
+    of the node and the nodes it is in, or None if none is set.
+    """
+    expires = None
+    for current in [node] + list(node.iterancestors()):
+        try:
+            expire_time = OneLogin_Saml2_Utils.get_expire_time(current.get('cacheDuration'), current.get('validUntil'))
+        except Exception, e:
+            raise IdPMetadataError('Invalid validity in IdP metadata: {}'.format(e))
+
+        if expire_time is not None and (expires is None or int(expire_time) < expires):
+            expires = int(expire_time)
+    return expires
+
+
+def check_metadata_signature(xml, cert):
+    """
+    Raise an IdPMetadataError unless the metadata document is signed, as a
+    whole, with `cert`.
+    """
+    try:
+        dom = fromstring(xml)
+    except Exception, e:
+        raise IdPMetadataError('Invalid IdP metadata: {}'.format(e))
+
+    # Only signatures of the whole document: others leave the rest of it open to changes
+    whole_document = ('', '#' + dom.get('ID')) if dom.get('ID') else ('', )
+    references = OneLogin_Saml2_Utils.query(dom, '//ds:Signature/ds:SignedInfo/ds:Reference')
+    if not references or any(reference.get('URI', '') not in whole_document for reference in references):
+        raise IdPMetadataError('The IdP metadata is not signed')
+
+    if not OneLogin_Saml2_Utils.validate_metadata_sign(xml, cert):
+        raise IdPMetadataError('The signature of the IdP metadata is not valid')
+
+
+def parse_idp_metadata(xml, entity_id=None, binding=OneLogin_Saml2_Constants.BINDING_HTTP_REDIRECT):
+    """
+    Parse IdP metadata into a dict with the `idp` settings for python-saml and
+    the time the metadata expires (`valid_until`, None if it does not).
+
+    All signing certificates are kept in `x509certMulti`, so responses signed
+    with any of them are accepted while the IdP rolls over to a new one. If
+    the metadata describes several IdPs, pass the `entity_id` of the one to use.
+    """
+    try:
+        dom = fromstring(xml)
+    except Exception, e:
+        raise IdPMetadataError('Invalid IdP metadata: {}'.format(e))
+
+    entities = [
+        node for node in OneLogin_Saml2_Utils.query(dom, '//md:EntityDescriptor')
+        if OneLogin_Saml2_Utils.query(node, './md:IDPSSODescriptor') and entity_id in (None, node.get('entityID'))
+    ]
+    if not entities:
+        raise IdPMetadataError('No IdP {}found in the metadata'.format(entity_id + ' ' if entity_id else ''))
+
+    entity = entities[0]
+    descriptor = OneLogin_Saml2_Utils.query(entity, './md:IDPSSODescriptor')[0]
+
+    certs = [''.join(node.text.split()) for node in OneLogin_Saml2_Utils.query(descriptor, SIGNING_CERTS)]
+    if not certs:
+        raise IdPMetadataError('No signing certificate found in the IdP metadata')
+
+    idp = {'entityId': entity.get('entityID'), 'x509cert': certs[0], 'x509certMulti': {'signing': certs}}
+    for key, service in (('singleSignOnService', 'SingleSignOnService'),
+                         ('singleLogoutService', 'SingleLogoutService')):
+        nodes = OneLogin_Saml2_Utils.query(descriptor, "./md:{}[@Binding='{}']".format(service, binding))
+        if nodes:
+            idp[key] = {'url': nodes[0].get('Location'), 'binding': binding}
+
+    if 'singleSignOnService' not in idp:
+        raise IdPMetadataError('No SingleSignOnService with binding {} found in the IdP metadata'.format(binding))
+
+    return {'idp': idp, 'valid_until': get_expires(entity)}
+
+
+class IdPMetadata(object):
+    """
+    IdP settings loaded from the metadata at `idp_metadata`, a file path or
+    URL, and merged into the SAML settings.
+
+    The metadata replaces the IdP certificates, so it should come from a
+    trusted source: URLs must use https, unless the metadata is signed with
+    the certificate set with `idp_metadata_cert`, which is then checked
+    (for files and https URLs too).
+
+    The parsed metadata is cached in the JSON file `idp_metadata_cache` (if
+    set), so processes start without fetching it. It is refreshed after
+    `idp_metadata_refresh` seconds (default 3600, 0 to only refresh when it
+    expires) or when it expires, in a background thread: requests keep using
+    the current settings until the new ones are swapped in.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.source = settings['idp_metadata']
+        self.cache_path = settings.get('idp_metadata_cache')
+        self.entity_id = settings.get('idp_metadata_entity_id')
+        self.cert = settings.get('idp_metadata_cert')
+        self.refresh_interval = settings.get('idp_metadata_refresh', 3600)
+        self.timeout = settings.get('idp_metadata_timeout', 10)
+        self.state = None
+        self.retry_at = 0
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        """
+        Load and parse the metadata from the source.
+        """
+        if self.source.startswith('http://') and not self.cert:
+            raise IdPMetadataError('Refusing to load unsigned IdP metadata over http from {}, use https or set '
+                                   'idp_metadata_cert'.format(self.source))
+
+        try:
+            if self.source.startswith(('http://', 'https://')):
+                xml = urllib2.urlopen(self.source, timeout=self.timeout).read()
+            else:
+                with open(self.source) as metadata_file:
+                    xml = metadata_file.read()
+        except (IOError, urllib2.URLError), e:
+            raise IdPMetadataError('Could not load the IdP metadata from {}: {}'.format(self.source, e))
+
+        if self.cert:
+            check_metadata_signature(xml, self.cert)
+        metadata = parse_idp_metadata(xml, entity_id=self.entity_id)
+        metadata.update(source=self.source, fetched=time.time())
+        return metadata
+
+    def read_cache(self):
+        """
+        Return the metadata from the cache file, or None if there is none
+        for the source.
+        """
+        if not self.cache_path:
+            return None
+
+        try:
+            with open(self.cache_path) as cache_file:
+                metadata = json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+
+        return metadata if metadata.get('source') == self.source else None
+
+    def write_cache(self, metadata):
+        """
+        Write the metadata to the cache file. The file is replaced at once,
+        so other processes never read a partial file.
+        """
+        if not self.cache_path:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        handle, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as cache_file:
+                json.dump(metadata, cache_file)
+            os.rename(path, self.cache_path)
+        except Exception:
+            os.remove(path)
+            raise
+
+    def is_due(self, metadata):
+        """
+        Return True if the metadata should be refreshed.
+        """
+        due = metadata['valid_until']
+        if self.refresh_interval:
+            due = min(due or float('inf'), metadata['fetched'] + self.refresh_interval)
+        return due is not None and due <= time.time()
+
+    def swap(self, metadata):
+        """
+        Use the settings from `metadata` for new requests.
+        """
+        settings = OneLogin_Saml2_IdPMetadataParser.merge_settings(self.settings, {'idp': metadata['idp']})
+        self.state = MetadataState(metadata, get_settings_hash(settings), settings)
+        return self.state
+
+    def refresh(self):
+        """
+        Load the metadata from the source, store it in the cache file and
+        use it. The cache file is used instead if it is not due for a
+        refresh, for example because another process just refreshed it.
+        """
+        metadata = self.read_cache()
+        if metadata is None or self.is_due(metadata):
+            metadata = self.fetch()
+            self.write_cache(metadata)
+        return self.swap(metadata)
+
+    def load(self):
+        """
+        Load the metadata on first use: from the cache file if it is there,
+        from the source otherwise. Raises IdPMetadataError if that fails, and
+        for RETRY_INTERVAL seconds after that without trying again.
+        """
+        with self._lock:
+            if self.state is None:
+                metadata = self.read_cache()
+                if metadata is None:
+                    if self.retry_at > time.time():
+                        raise IdPMetadataError('The IdP metadata from {} is not available, retrying in {:.0f}s'.format(
+                            self.source, self.retry_at - time.time()
+                        ))
+
+                    self.retry_at = time.time() + RETRY_INTERVAL
+                    metadata = self.fetch()
+                    self.write_cache(metadata)
+                self.swap(metadata)
+            return self.state
+
+    def _refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception('Refreshing the IdP metadata from {} failed'.format(self.source))
+
+            valid_until = self.state.metadata['valid_until']
+            if valid_until and valid_until < time.time():
+                logger.error('The IdP metadata from {} expired, using it anyway'.format(self.source))
+
+    def refresh_in_background(self):
+        """
+        Start refreshing the metadata in a background thread, unless a
+        refresh is already running or was started less than RETRY_INTERVAL
+        seconds ago.
+        """
+        with self._lock:
+            if (self.thread and self.thread.is_alive()) or self.retry_at > time.time():
+                return
+
+            self.retry_at = time.time() + RETRY_INTERVAL
+            self.thread = threading.Thread(target=self._refresh, name='token_auth.idp_metadata')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def get_settings(self):
+        """
+        Return the hash and the SAML settings with the current IdP settings.
+        """
+        state = self.state or self.load()
+        if self.is_due(state.metadata):
+            self.refresh_in_background()
+        return state.settings_hash, state.settings
+
+
+def get_idp_metadata(config):
+    """
+    Return the IdPMetadata for the config, or None if `idp_metadata` is not set.
+    """
+    def create():
+        if not config.settings.get('idp_metadata'):
+            return None
+        return IdPMetadata(config.settings)
+
+    return config.get_or_set('idp_metadata', create)
+
+
+def get_idp_settings(config):
+    """
+    Return the hash and the settings to configure python-saml with: the
+    config's settings, with the IdP settings from the metadata if it is set up.
+    """
+    idp_metadata = get_idp_metadata(config)
+    if idp_metadata is None:
+        return config.settings_hash, config.settings
+    return idp_metadata.get_settings()
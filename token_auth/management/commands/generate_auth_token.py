@@ -1,7 +1,15 @@
+import csv
+import json
+import sys
+import time
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Pool
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
-from token_auth.auth.booking import generate_token
+from django.core.management.base import BaseCommand, CommandError
+from token_auth.auth.booking import generate_token, generate_tokens
+from token_auth.management.readers import READERS
 
 try:
     from django.utils.six.moves import input
@@ -9,6 +17,77 @@ except ImportError:
     input = raw_input
 
 
+def check_row(row):
+    """
+    Return why no token can be generated for a row, or None if it can.
+    """
+    if not isinstance(row, dict):
+        return 'not an object'
+    email = row.get('email')
+    if not email:
+        return 'no email'
+    local_part, _, domain = email.partition('@')
+    if not local_part or not domain or '@' in domain:
+        return u'invalid email {0}'.format(email)
+    return None
+
+
+def get_record(row):
+    """
+    Return the (email, username, first_name, last_name) tuple for a row
+    that passed `check_row`, with the same defaults as the interactive mode.
+    """
+    email = row['email']
+    local_part, domain = email.split('@')
+    return (
+        email,
+        row.get('username') or local_part,
+        row.get('first_name') or local_part.title(),
+        row.get('last_name') or domain.split('.')[0].title(),
+    )
+
+
+def generate_chunk(rows):
+    """
+    Return the rows with a `token` added.
+    """
+    tokens = generate_tokens((get_record(row) for row in rows), chunk_size=len(rows))
+    return [dict(row, token=token) for row, token in zip(rows, tokens)]
+
+
+class RowWriter(object):
+    def __init__(self, output_file, file_format):
+        self.output_file = output_file
+        self.file_format = file_format
+        self.csv = None
+
+    def write(self, row):
+        if self.file_format == 'jsonl':
+            self.output_file.write(json.dumps(row) + '\n')
+            return
+
+        if self.csv is None:
+            self.csv = csv.DictWriter(self.output_file, fieldnames=sorted(row.keys()))
+            self.csv.writeheader()
+        self.csv.writerow(dict((key, unicode(value).encode('utf-8')) for key, value in row.items()))
+
+
+@contextmanager
+def open_file(path, mode, default):
+    if path in (None, '-'):
+        yield default
+    else:
+        with open(path, mode) as opened:
+            yield opened
+
+
+def get_format(file_format, path):
+    file_format = file_format or (path or '').rsplit('.', 1)[-1]
+    if file_format not in ('csv', 'jsonl'):
+        raise CommandError('Unknown file format: {0}, use --format'.format(file_format))
+    return file_format
+
+
 class Command(BaseCommand):
     help = "Generate a authentication token"
 
@@ -20,11 +99,28 @@ class Command(BaseCommand):
                         help="Last name for the user."),
             make_option('--last-name', '-l', dest='last-name', default=None,
                         help="First name for the user."),
+            make_option('--input', '-i', dest='input', default=None,
+                        help="CSV or JSON lines file with users (email, username, first_name, last_name) "
+                             "to generate tokens for, or - for stdin."),
+            make_option('--output', '-o', dest='output', default=None,
+                        help="File to write the users with their token to. Defaults to stdout."),
+            make_option('--format', dest='format', default=None, choices=('csv', 'jsonl'),
+                        help="Format of the input and output (csv or jsonl). Defaults to the input extension."),
+            make_option('--processes', '-p', dest='processes', type='int', default=1,
+                        help="Number of processes to generate tokens with."),
+            make_option('--chunk-size', dest='chunk-size', type='int', default=1000,
+                        help="Number of tokens a process generates at once."),
         )
 
         super(Command, self).__init__()
 
     def handle(self, *args, **options):
+        if options.get('input'):
+            self.handle_batch(options)
+        else:
+            self.handle_interactive(options)
+
+    def handle_interactive(self, options):
         if options.get('email'):
             email = options['email']
         else:
@@ -53,3 +149,45 @@ class Command(BaseCommand):
         token = generate_token(email=email, username=username,
                                first_name=first_name, last_name=last_name)
         self.stdout.write('Token:  {0}'.format(token))
+
+    def handle_batch(self, options):
+        file_format = get_format(options.get('format'), options['input'])
+        chunk_size = options['chunk-size']
+        processes = options['processes']
+        start = time.time()
+        count = 0
+        skipped = []
+
+        def read_rows(input_file):
+            # Invalid rows are skipped and reported, instead of failing halfway through the output
+            for line_number, row in READERS[file_format](input_file):
+                error = check_row(row)
+                if error:
+                    skipped.append(line_number)
+                    self.stderr.write(u'Skipped line {0}: {1}'.format(line_number, error))
+                else:
+                    yield row
+
+        with open_file(options['input'], 'r', sys.stdin) as input_file, \
+                open_file(options.get('output'), 'w', self.stdout) as output_file:
+            rows = read_rows(input_file)
+            chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+            writer = RowWriter(output_file, file_format)
+
+            pool = Pool(processes) if processes > 1 else None
+            try:
+                results = pool.imap(generate_chunk, chunks) if pool else (generate_chunk(chunk) for chunk in chunks)
+                for chunk in results:
+                    for row in chunk:
+                        writer.write(row)
+                    count += len(chunk)
+            finally:
+                if pool:
+                    pool.terminate()
+
+        elapsed = time.time() - start
+        self.stderr.write('Generated {0} tokens in {1:.2f} seconds ({2:.0f} tokens/s)'.format(
+            count, elapsed, count / max(elapsed, 0.001)
+        ))
+        if skipped:
+            self.stderr.write('Skipped {0} invalid rows'.format(len(skipped)))
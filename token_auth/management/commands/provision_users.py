@@ -0,0 +1,45 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from token_auth.management.readers import READERS
+from token_auth.provisioning import provision_users
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = "Create or update users from a CSV or JSON lines file with SSO attributes"
+
+    def __init__(self):
+        self.option_list = self.option_list + (
+            make_option('--format', '-f', dest='format', default=None, choices=('csv', 'jsonl'),
+                        help="Format of the file (csv or jsonl). Defaults to the file extension."),
+            make_option('--batch-size', '-b', dest='batch-size', type='int', default=1000,
+                        help="Number of users to process at once."),
+        )
+
+        super(Command, self).__init__()
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: provision_users {0}'.format(self.args))
+
+        path = args[0]
+        file_format = options.get('format') or path.rsplit('.', 1)[-1]
+        if file_format not in READERS:
+            raise CommandError('Unknown file format: {0}'.format(file_format))
+
+        start = time.time()
+
+        def progress(totals):
+            processed = sum(totals.values())
+            self.stdout.write('Processed {0} users ({1:.0f} users/s)'.format(
+                processed, processed / max(time.time() - start, 0.001)
+            ))
+
+        with open(path) as input_file:
+            records = (record for line_number, record in READERS[file_format](input_file))
+            totals = provision_users(records, batch_size=options['batch-size'], progress=progress)
+
+        self.stdout.write('Created {created}, updated {updated}, unchanged {unchanged} users'.format(**totals))
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from token_auth.models import CheckedToken
+from token_auth.utils import get_settings
+
+
+class Command(BaseCommand):
+    help = "Delete used tokens that are expired"
+
+    def __init__(self):
+        self.option_list = self.option_list + (
+            make_option('--batch-size', '-b', dest='batch-size', type='int', default=1000,
+                        help="Number of tokens to delete at once."),
+            make_option('--sleep', '-s', dest='sleep', type='float', default=0,
+                        help="Seconds to wait between batches."),
+        )
+
+        super(Command, self).__init__()
+
+    def handle(self, *args, **options):
+        deleted, elapsed = CheckedToken.objects.prune(
+            get_settings()['token_expiration'],
+            batch_size=options['batch-size'],
+            sleep=options['sleep']
+        )
+        self.stdout.write('Deleted {0} tokens in {1:.2f} seconds'.format(deleted, elapsed))
@@ -0,0 +1,62 @@
+import json
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from token_auth.exceptions import IdPMetadataError, UnknownTenant
+from token_auth.idp_metadata import IdPMetadata
+from token_auth.tenants import get_tenant_registry
+from token_auth.utils import get_config
+
+
+class Command(BaseCommand):
+    help = "Load the IdP metadata from the `idp_metadata` setting and store it in the `idp_metadata_cache` file"
+
+    def __init__(self):
+        self.option_list = self.option_list + (
+            make_option('--tenant', '-t', dest='tenant', default=None,
+                        help="Tenant to refresh the IdP metadata of."),
+            make_option('--dry-run', action='store_true', dest='dry-run', default=False,
+                        help="Print the IdP settings from the metadata instead of storing them."),
+        )
+
+        super(Command, self).__init__()
+
+    def get_config(self, tenant):
+        config = get_config()
+        if tenant is None:
+            return config
+
+        registry = get_tenant_registry(config)
+        if registry is None:
+            raise CommandError('Tenants are not set up (`tenant_loader`)')
+
+        try:
+            return registry.get_config(tenant)
+        except UnknownTenant:
+            raise CommandError('Unknown tenant: {0}'.format(tenant))
+
+    def handle(self, *args, **options):
+        config = self.get_config(options.get('tenant'))
+        if not config.settings.get('idp_metadata'):
+            raise CommandError('The `idp_metadata` setting is not set')
+        if not config.settings.get('idp_metadata_cache') and not options['dry-run']:
+            raise CommandError('The `idp_metadata_cache` setting is not set')
+
+        idp_metadata = IdPMetadata(config.settings)
+        try:
+            metadata = idp_metadata.fetch()
+        except IdPMetadataError, e:
+            raise CommandError(str(e))
+
+        if options['dry-run']:
+            self.stdout.write(json.dumps(metadata['idp'], indent=2, sort_keys=True))
+        else:
+            idp_metadata.write_cache(metadata)
+
+        valid_until = metadata['valid_until']
+        self.stdout.write('Loaded {0} with {1} signing certificate(s), valid until {2}'.format(
+            metadata['idp']['entityId'], len(metadata['idp']['x509certMulti']['signing']),
+            datetime.utcfromtimestamp(valid_until).isoformat() + 'Z' if valid_until else 'further notice'
+        ))
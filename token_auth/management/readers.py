@@ -0,0 +1,33 @@
+import csv
+import json
+
+from django.core.management.base import CommandError
+
+
+def read_csv(input_file):
+    """
+    Yield the line number and a dict for each row of a CSV file with a
+    header. Values missing from short rows are left out, extra ones ignored.
+    """
+    reader = csv.DictReader(input_file)
+    for row in reader:
+        yield reader.line_num, dict(
+            (key, value.decode('utf-8')) for key, value in row.items() if key is not None and value is not None
+        )
+
+
+def read_jsonl(input_file):
+    """
+    Yield the line number and the decoded object for each line of a JSON
+    lines file, skipping empty lines.
+    """
+    for line_number, line in enumerate(input_file, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            raise CommandError('Line {0} is not valid JSON'.format(line_number))
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
@@ -0,0 +1,124 @@
+import logging
+import socket
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from token_auth.signals import stage_finished
+
+logger = logging.getLogger(__name__)
+
+
+class NullMetrics(object):
+    """
+    Metrics backend that discards all metrics. Subclass it to send them
+    somewhere else.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+
+    def timing(self, name, milliseconds, tags=None):
+        pass
+
+    def histogram(self, name, value, tags=None):
+        pass
+
+
+class StatsdMetrics(NullMetrics):
+    """
+    Send the metrics to a statsd server over UDP, with DogStatsD style tags.
+    Uses the `metrics_host`, `metrics_port` and `metrics_prefix` settings.
+    """
+    def __init__(self, settings):
+        super(StatsdMetrics, self).__init__(settings)
+        self.prefix = settings.get('metrics_prefix', 'token_auth')
+        self.address = (settings.get('metrics_host', 'localhost'), settings.get('metrics_port', 8125))
+        self.socket = None
+
+    def format(self, name, value, metric_type, tags=None):
+        line = '{0}.{1}:{2}|{3}'.format(self.prefix, name, value, metric_type)
+        if tags:
+            line += '|#' + ','.join('{0}:{1}'.format(key, value) for key, value in sorted(tags.items()))
+        return line
+
+    def send(self, line):
+        try:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.sendto(line, self.address)
+        except socket.error, e:
+            # Metrics should never break a login
+            logger.warning('Could not send metrics: {}'.format(e))
+
+    def timing(self, name, milliseconds, tags=None):
+        self.send(self.format(name, '{0:.3f}'.format(milliseconds), 'ms', tags))
+
+    def histogram(self, name, value, tags=None):
+        self.send(self.format(name, value, 'h', tags))
+
+
+class LoggingMetrics(StatsdMetrics):
+    """
+    Write the metrics in statsd format to the `token_auth.metrics` logger.
+    """
+    def send(self, line):
+        logger.info(line)
+
+
+def get_metrics(config):
+    """
+    Return the metrics backend set with the `metrics` setting, which
+    defaults to `NullMetrics`.
+    """
+    def create():
+        return import_string(config.settings.get('metrics', 'token_auth.metrics.NullMetrics'))(config.settings)
+
+    return config.get_or_set('metrics', create)
+
+
+def record_stage(backend, stage, duration, error=None, queries=None):
+    """
+    Send the metrics and the `stage_finished` signal for a stage.
+    """
+    outcome = 'error' if error else 'success'
+    tags = {'backend': backend.__class__.__name__, 'outcome': outcome}
+    if error:
+        tags['error'] = error.__class__.__name__
+
+    metrics = get_metrics(backend.config.root)
+    metrics.timing(stage, duration * 1000, tags)
+    if queries is not None:
+        metrics.histogram(stage + '.queries', queries, tags)
+
+    stage_finished.send(sender=backend.__class__, backend=backend, stage=stage, duration=duration,
+                        outcome=outcome, error=error, queries=queries)
+
+
+@contextmanager
+def measure_stage(backend, stage):
+    """
+    Measure the duration, outcome and (if the `metrics_queries` setting is
+    set) the number of queries of the wrapped code as `stage` of `backend`.
+    """
+    count_queries = backend.settings.get('metrics_queries', False)
+    if count_queries:
+        force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        initial_queries = len(connection.queries_log)
+
+    error = queries = None
+    start = default_timer()
+    try:
+        yield
+    except Exception, e:
+        error = e
+        raise
+    finally:
+        duration = default_timer() - start
+        if count_queries:
+            connection.force_debug_cursor = force_debug_cursor
+            queries = len(connection.queries_log) - initial_queries
+
+        record_stage(backend, stage, duration, error, queries)
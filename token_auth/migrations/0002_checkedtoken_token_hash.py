@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+from django.utils.encoding import force_bytes
+
+
+def set_token_hash(apps, schema_editor):
+    CheckedToken = apps.get_model('token_auth', 'CheckedToken')
+
+    seen = set()
+    for checked_token in CheckedToken.objects.order_by('pk').iterator():
+        token_hash = hashlib.sha256(force_bytes(checked_token.token)).hexdigest()
+        if token_hash in seen:
+            # Without a unique constraint the same token could be stored twice.
+            checked_token.delete()
+        else:
+            seen.add(token_hash)
+            CheckedToken.objects.filter(pk=checked_token.pk).update(token_hash=token_hash)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('token_auth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkedtoken',
+            name='token_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.RunPython(set_token_hash, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='checkedtoken',
+            name='token_hash',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
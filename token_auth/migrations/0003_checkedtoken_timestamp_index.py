@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 11:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('token_auth', '0002_checkedtoken_token_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='checkedtoken',
+            name='timestamp',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 11:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('token_auth', '0003_checkedtoken_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoginAuditEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(db_index=True)),
+                ('backend', models.CharField(max_length=100)),
+                ('remote_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('created', models.BooleanField(default=False)),
+                ('outcome', models.CharField(max_length=20)),
+                ('error_code', models.CharField(blank=True, max_length=50, null=True)),
+                ('latency', models.FloatField(help_text='Milliseconds')),
+                ('client_ip', models.GenericIPAddressField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ('-timestamp',),
+            },
+        ),
+    ]
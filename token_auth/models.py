@@ -1,5 +1,55 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+
+def get_token_hash(token):
+    """
+    Fixed length (SHA-256) digest of a token, used to look up used tokens.
+    """
+    return hashlib.sha256(force_bytes(token)).hexdigest()
+
+
+class CheckedTokenManager(models.Manager):
+
+    def is_used(self, token):
+        return self.filter(token_hash=get_token_hash(token)).exists()
+
+    def prune(self, expiration, batch_size=1000, sleep=0):
+        """
+        Delete the tokens that are older than `expiration` seconds. Those are
+        rejected as expired anyway, so they are not needed for replay checks.
+
+        Rows are deleted in batches of `batch_size`, sleeping `sleep` seconds
+        in between, to keep locks short while logins continue.
+        Returns a tuple of the number of deleted rows and the elapsed time.
+        """
+        start = time.time()
+        deleted = 0
+
+        limit = timezone.now() - timedelta(seconds=expiration)
+        expired = self.filter(timestamp__lt=limit).order_by('timestamp')
+
+        while True:
+            pks = list(expired.values_list('pk', flat=True)[:batch_size])
+            if pks:
+                self.filter(pk__in=pks).delete()
+                deleted += len(pks)
+
+            if len(pks) < batch_size:
+                break
+
+            if sleep:
+                time.sleep(sleep)
+
+        return deleted, time.time() - start
 
 
 class CheckedToken(models.Model):
@@ -7,12 +57,66 @@ class CheckedToken(models.Model):
     Stores the used tokens for safety-checking purposes.
     """
     token = models.CharField(max_length=300)
-    timestamp = models.DateTimeField()
+    token_hash = models.CharField(max_length=64, unique=True)
+    timestamp = models.DateTimeField(db_index=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
 
+    objects = CheckedTokenManager()
+
     class Meta:
         ordering = ('-timestamp', 'user__username')
 
     def __unicode__(self):
         return '{0} - {1}, {2}'.format(
             self.token, self.timestamp, self.user.username)
+
+    def save(self, *args, **kwargs):
+        if not self.token_hash:
+            self.token_hash = get_token_hash(self.token)
+        super(CheckedToken, self).save(*args, **kwargs)
+
+
+class LoginAuditEvent(models.Model):
+    """
+    Outcome of a login attempt, written by `token_auth.audit.ModelSink`.
+    """
+    timestamp = models.DateTimeField(db_index=True)
+    backend = models.CharField(max_length=100)
+    remote_id = models.CharField(max_length=255, null=True, blank=True)
+    created = models.BooleanField(default=False)
+    outcome = models.CharField(max_length=20)
+    error_code = models.CharField(max_length=50, null=True, blank=True)
+    latency = models.FloatField(help_text='Milliseconds')
+    client_ip = models.GenericIPAddressField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-timestamp', )
+
+    def __unicode__(self):
+        return '{0} - {1}, {2}'.format(self.remote_id, self.outcome, self.timestamp)
+
+
+class Tenant(models.Model):
+    """
+    TOKEN_AUTH settings of a tenant, loaded by
+    `token_auth.tenants.ModelTenantLoader`.
+    """
+    name = models.CharField(max_length=255, unique=True, help_text='Host name or name in the URL')
+    settings = models.TextField(help_text='JSON object with the settings that differ from TOKEN_AUTH')
+    is_active = models.BooleanField(default=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('name', )
+
+    def __unicode__(self):
+        return self.name
+
+    def clean(self):
+        try:
+            settings = json.loads(self.settings)
+        except ValueError, e:
+            raise ValidationError({'settings': 'Invalid JSON: {}'.format(e)})
+
+        if not isinstance(settings, dict):
+            raise ValidationError({'settings': 'Settings should be a JSON object'})
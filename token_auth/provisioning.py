@@ -0,0 +1,125 @@
+from collections import defaultdict
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Value, When
+from django.db.models.functions import Lower
+
+from token_auth.auth.base import BaseTokenAuthentication, get_changes
+
+
+# Number of users updated per query, within the query parameter limit of SQLite
+UPDATE_CHUNK_SIZE = 100
+
+
+def _get_existing_users(user_model, remote_ids):
+    """
+    Return a dict mapping the lowercased remote_id to the user, for all
+    users that match one of `remote_ids`, and lock them for the current
+    transaction. Like `get_user`, prefer an exact match and fall back to a
+    case insensitive one.
+    """
+    users = user_model.objects.select_for_update()
+    existing = dict(
+        (user.remote_id.lower(), user) for user in users.filter(remote_id__in=remote_ids)
+    )
+
+    missing = set(remote_id.lower() for remote_id in remote_ids) - set(existing)
+    if missing:
+        queryset = users.annotate(lower_remote_id=Lower('remote_id')).filter(lower_remote_id__in=missing)
+        for user in queryset:
+            existing.setdefault(user.lower_remote_id, user)
+
+    return existing
+
+
+def _update_users(user_model, updates):
+    """
+    Save `updates`, a list of (pk, changes) tuples, with one query per set
+    of changed fields (and chunk of users).
+    """
+    groups = defaultdict(list)
+    for pk, changes in updates:
+        groups[frozenset(changes)].append((pk, changes))
+
+    for fields, group in groups.items():
+        for index in range(0, len(group), UPDATE_CHUNK_SIZE):
+            chunk = group[index:index + UPDATE_CHUNK_SIZE]
+            values = dict(
+                (name, Case(
+                    *[When(pk=pk, then=Value(changes[name])) for pk, changes in chunk],
+                    output_field=user_model._meta.get_field(name)
+                ))
+                for name in fields
+            )
+            user_model.objects.filter(pk__in=[pk for pk, changes in chunk]).update(**values)
+
+
+def _provision_batch(user_model, batch):
+    """
+    Create or update the users in `batch`, a dict mapping the lowercased
+    remote_id to user data. Returns a tuple with the number of created,
+    updated and unchanged users.
+    """
+    new_users = []
+    updates = []
+
+    with transaction.atomic():
+        existing = _get_existing_users(user_model, [user_data['remote_id'] for user_data in batch.values()])
+
+        for key, user_data in batch.items():
+            if key not in existing:
+                new_users.append(user_model(**user_data))
+                continue
+
+            user = existing[key]
+            changes = get_changes(user, user_data)
+            if changes:
+                updates.append((user.pk, changes))
+
+        _update_users(user_model, updates)
+        user_model.objects.bulk_create(new_users)
+
+    return len(new_users), len(updates), len(batch) - len(new_users) - len(updates)
+
+
+def provision_users(records, batch_size=1000, progress=None):
+    """
+    Create or update users from an iterable of dicts with SSO attributes,
+    like the ones returned by `authenticate_request()`. Each record should
+    at least contain a `remote_id`.
+
+    Records are processed in batches of `batch_size`, each using a few
+    queries and one transaction. A batch is tried again once when it
+    conflicts with users created at the same time. If a `progress` callable is given, it is
+    called with the running totals after each batch.
+
+    Returns a dict with the number of `created`, `updated` and `unchanged` users.
+    """
+    user_model = get_user_model()
+    auth = BaseTokenAuthentication(None)
+    records = iter(records)
+    totals = {'created': 0, 'updated': 0, 'unchanged': 0}
+
+    while True:
+        batch = {}
+        for data in islice(records, batch_size):
+            data = dict(data, is_active=True)
+            # Remote ids that only differ in case are the same user, like when logging in
+            batch[data['remote_id'].lower()] = auth.get_user_data(data)
+
+        if not batch:
+            return totals
+
+        try:
+            created, updated, unchanged = _provision_batch(user_model, batch)
+        except IntegrityError:
+            # Users of the batch were created in the meantime (by logging in), update them instead
+            created, updated, unchanged = _provision_batch(user_model, batch)
+        totals['created'] += created
+        totals['updated'] += updated
+        totals['unchanged'] += unchanged
+
+        if progress:
+            progress(totals)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the token login path.
+
+    python token_auth/runbenchmarks.py [--sizes 10000,100000,1000000] [--output results.json]
+
+Every benchmark reports operations per second, p50/p99 latency and the
+number of queries per operation. Use --output to write the results as JSON,
+so they can be compared between runs.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+
+import mock
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests')
+
+BOOKING_SETTINGS = {
+    'backend': 'token_auth.auth.booking.TokenAuthentication',
+    'sso_url': 'https://example.org',
+    'token_expiration': 600,
+    'hmac_key': 'bbbbbbbbbbbbbbbb',
+    'aes_key': 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+}
+
+
+def setup_django():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        AUTH_USER_MODEL='tests.TestUser',
+        USE_TZ=True,
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'token_auth',
+            'token_auth.tests'
+        ),
+        MIDDLEWARE_CLASSES=(),
+        ROOT_URLCONF='token_auth.urls',
+        ALLOWED_HOSTS=['*'],
+        TOKEN_AUTH=BOOKING_SETTINGS
+    )
+
+    django.setup()
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def percentile(timings, percent):
+    return timings[min(len(timings) - 1, int(len(timings) * percent / 100.0))]
+
+
+def measure(name, func, iterations, setup=None, **extra):
+    """
+    Call `func` `iterations` times and return the statistics. If `setup` is
+    given, it is called (untimed) before each call, and its result is passed
+    to `func`.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings = []
+    queries = 0
+    for index in range(iterations):
+        args = (setup(index), ) if setup else ()
+        with CaptureQueriesContext(connection) as context:
+            start = timeit.default_timer()
+            func(*args)
+            timings.append(timeit.default_timer() - start)
+        queries += len(context)
+
+    timings.sort()
+    result = {
+        'name': name,
+        'iterations': iterations,
+        'ops_per_sec': iterations / sum(timings),
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'queries_per_op': float(queries) / iterations,
+    }
+    result.update(extra)
+    return result
+
+
+def new_token(index):
+    from token_auth.auth.booking import generate_token
+
+    return generate_token(
+        email='user-{0}@example.com'.format(index), username='user-{0}'.format(index),
+        first_name='User', last_name=str(index)
+    )
+
+
+def create_checked_tokens(count):
+    """
+    Fill the CheckedToken table up to `count` rows.
+    """
+    from django.utils import timezone
+
+    from token_auth.models import CheckedToken, get_token_hash
+    from token_auth.tests.models import TestUser
+
+    user, _created = TestUser.objects.get_or_create(email='bench@example.com', remote_id='bench@example.com')
+    timestamp = timezone.now()
+    existing = CheckedToken.objects.count()
+
+    for start in range(existing, count, 10000):
+        CheckedToken.objects.bulk_create([
+            CheckedToken(token='bench-{0}'.format(index), token_hash=get_token_hash('bench-{0}'.format(index)),
+                         timestamp=timestamp, user=user)
+            for index in range(start, min(start + 10000, count))
+        ])
+
+
+def legacy_parse_login_data(data):
+    """
+    The message parsing of `decrypt_message` before it used a precompiled
+    parser, to compare with.
+    """
+    import re
+    import string
+
+    expression = r'(.*?)\|'
+    pattern = r'time={0}username={0}name={0}email=(.*)'.format(expression)
+    login_data = re.search(pattern, data).groups()
+
+    name = login_data[2].strip()
+    first_name = name.split(' ').pop(0)
+    parts = name.split(' ')
+    parts.pop(0)
+    last_name = " ".join(parts)
+    email = login_data[3].strip()
+    email = filter(lambda x: x in string.printable, email)
+    return login_data[0], first_name, last_name, email
+
+
+def parse_login_data(data):
+    from token_auth.auth.booking import NON_PRINTABLE, parse_login_data
+
+    login_data = parse_login_data(data)
+    first_name, _, last_name = login_data.name.strip().partition(' ')
+    return login_data.timestamp, first_name, last_name, login_data.email.strip().translate(None, NON_PRINTABLE)
+
+
+def benchmark_crypto(iterations):
+    from django.test import RequestFactory
+
+    from token_auth.auth.booking import TokenAuthentication, generate_token
+
+    token = new_token(0)
+    auth = TokenAuthentication(RequestFactory().get('/login/'), token=token)
+    message = base64.urlsafe_b64decode(str(token))
+    data = 'time={0}|username=johndoe|name=John Doe|email=john.doe@example.com\x04\x04\x04\x04'.format(
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    )
+
+    return [
+        measure('generate_token', lambda: generate_token('john.doe@example.com', 'johndoe', 'John', 'Doe'),
+                iterations),
+        measure('decrypt_message', auth.decrypt_message, iterations),
+        measure('check_hmac_signature', lambda: auth.check_hmac_signature(message), iterations),
+        measure('get_login_data', lambda: auth.get_login_data(data), iterations),
+        measure('parse_login_data', lambda: parse_login_data(data), iterations, implementation='current'),
+        measure('parse_login_data', lambda: legacy_parse_login_data(data), iterations, implementation='legacy'),
+    ]
+
+
+def benchmark_check_token_used(iterations, sizes):
+    from django.test import RequestFactory
+
+    from token_auth.auth.booking import TokenAuthentication
+
+    request = RequestFactory().get('/login/')
+    results = []
+    for size in sizes:
+        create_checked_tokens(size)
+        results.append(measure(
+            'check_token_used', lambda auth: auth.check_token_used(), iterations,
+            setup=lambda index: TokenAuthentication(request, token='unused-{0}'.format(index)),
+            checked_tokens=size
+        ))
+    return results
+
+
+def benchmark_get_or_create_user(iterations):
+    from token_auth.auth.base import BaseTokenAuthentication
+
+    auth = BaseTokenAuthentication(None)
+
+    def user_data(index):
+        return {
+            'remote_id': 'user-{0}@example.com'.format(index), 'email': 'user-{0}@example.com'.format(index),
+            'first_name': 'User', 'last_name': str(index), 'is_active': True
+        }
+
+    return [
+        measure('get_or_create_user', auth.get_or_create_user, iterations, setup=user_data, user='new'),
+        measure('get_or_create_user', auth.get_or_create_user, iterations, setup=user_data, user='returning'),
+    ]
+
+
+def check_login(response):
+    if not response.get('Location', '').startswith('/login-with/'):
+        raise AssertionError('Login failed: {0}'.format(response.get('Location')))
+
+
+def benchmark_login_view(iterations):
+    from django.core.urlresolvers import reverse
+    from django.test import Client
+    from django.test.utils import override_settings
+
+    from token_auth.stores import get_assertion_store
+    from token_auth.tests.models import TestUser
+    from token_auth.tests.saml_settings import TOKEN_AUTH_SETTINGS as SAML_SETTINGS
+    from token_auth.utils import get_config
+
+    client = Client()
+    with open(os.path.join(TEST_DIR, 'data', 'valid_response.xml.base64')) as response_file:
+        saml_response = response_file.read()
+
+    with mock.patch.object(TestUser, 'get_login_token', create=True, return_value='token'):
+        results = [measure(
+            'login_view', lambda token: check_login(client.get(reverse('token-login', kwargs={'token': token}))),
+            iterations, setup=new_token, backend='booking'
+        )]
+
+        with override_settings(TOKEN_AUTH=dict(SAML_SETTINGS, backend='token_auth.auth.saml.SAMLAuthentication')):
+            # The same response is posted every time, so forget it was used
+            results.append(measure(
+                'login_view',
+                lambda _cleared: check_login(client.post(
+                    reverse('token-login', kwargs={'token': ''}), {'SAMLResponse': saml_response},
+                    HTTP_HOST='www.stuff.com'
+                )),
+                iterations, setup=lambda index: get_assertion_store(get_config()).local.clear(), backend='saml'
+            ))
+
+    return results
+
+
+def format_result(result):
+    extra = ', '.join(
+        '{0}={1}'.format(key, value) for key, value in sorted(result.items())
+        if key not in ('name', 'iterations', 'ops_per_sec', 'p50_ms', 'p99_ms', 'queries_per_op')
+    )
+    return '{name:<24} {extra:<24} {ops_per_sec:>12.1f} ops/s  p50 {p50_ms:>8.3f} ms  ' \
+           'p99 {p99_ms:>8.3f} ms  {queries_per_op:>5.1f} queries'.format(extra=extra, **result)
+
+
+def runbenchmarks(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the token login path')
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='Number of operations per benchmark')
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='Comma separated CheckedToken table sizes for check_token_used')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    options = parser.parse_args(args)
+
+    setup_django()
+
+    sizes = [int(size) for size in options.sizes.split(',') if size]
+    results = []
+    for benchmark in (benchmark_crypto, benchmark_get_or_create_user, benchmark_login_view):
+        for result in benchmark(options.iterations):
+            print(format_result(result))
+            results.append(result)
+
+    for result in benchmark_check_token_used(options.iterations, sizes):
+        print(format_result(result))
+        results.append(result)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({'date': datetime.now().isoformat(), 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    runbenchmarks(sys.argv[1:])
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+
+# Sent when a stage of the authentication (like `authenticate_request`,
+# `get_or_create_user` or `finalize`) is finished, successful or not. The
+# sender is the authentication backend class. `duration` is in seconds,
+# `outcome` is 'success' or 'error', `error` the exception (if any) and
+# `queries` the number of database queries (None unless `metrics_queries`
+# is set).
+stage_finished = Signal(providing_args=['backend', 'stage', 'duration', 'outcome', 'error', 'queries'])
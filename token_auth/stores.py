@@ -0,0 +1,133 @@
+import math
+import time
+
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+
+from token_auth.caches import LRUCache
+from token_auth.models import CheckedToken, get_token_hash
+
+
+class BaseTokenStore(object):
+    """
+    Keeps track of used tokens, to prevent replay attacks.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+
+    def is_used(self, token):
+        """
+        Return True if the token was used before.
+        """
+        raise NotImplementedError()
+
+    def mark_used(self, token, user, timestamp):
+        """
+        Store the token as used. This should be atomic: returns False if the
+        token was already used, True otherwise.
+        """
+        raise NotImplementedError()
+
+
+class ModelTokenStore(BaseTokenStore):
+    """
+    Stores used tokens in the database, using the `CheckedToken` model.
+    """
+    def is_used(self, token):
+        return CheckedToken.objects.is_used(token)
+
+    def mark_used(self, token, user, timestamp):
+        # The unique token hash makes this insert the actual replay check:
+        # of two concurrent requests with the same token only one succeeds.
+        try:
+            with transaction.atomic():
+                CheckedToken.objects.create(token=token, user=user, timestamp=timestamp)
+        except IntegrityError:
+            return False
+        return True
+
+
+class CacheTokenStore(BaseTokenStore):
+    """
+    Stores used tokens in Django's cache framework, for the duration of the
+    `token_expiration` setting. Configure the cache to use with
+    `token_store_cache` (defaults to 'default').
+
+    Only use this with a cache that is shared between all processes (like
+    memcached or redis), otherwise tokens can be replayed on other processes.
+    """
+    key_prefix = 'token_auth:used:'
+
+    def __init__(self, settings):
+        super(CacheTokenStore, self).__init__(settings)
+        self.cache_alias = settings.get('token_store_cache', 'default')
+        self.timeout = settings['token_expiration']
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_key(self, token):
+        return self.key_prefix + get_token_hash(token)
+
+    def is_used(self, token):
+        return self.cache.get(self.get_key(token)) is not None
+
+    def mark_used(self, token, user, timestamp):
+        return self.cache.add(self.get_key(token), user.pk, self.timeout)
+
+
+class AssertionStore(object):
+    """
+    Keeps track of the IDs of accepted SAML responses and assertions until
+    they expire, to prevent replay attacks.
+
+    IDs are kept in an in-process LRU cache of `saml_replay_cache_size` IDs
+    (default 100000), and in the Django cache `saml_replay_cache` if it is
+    set. Set it to a cache shared by all processes, otherwise responses can
+    be replayed on other processes.
+    """
+    key_prefix = 'token_auth:saml:'
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.local = LRUCache(settings.get('saml_replay_cache_size', 100000))
+        self.cache_alias = settings.get('saml_replay_cache')
+        self.default_timeout = settings.get('saml_replay_timeout', 3600)
+
+    def get_key(self, saml_id):
+        return self.key_prefix + get_token_hash(saml_id)
+
+    def get_timeout(self, expires):
+        """
+        Seconds until `expires` (a timestamp), or `saml_replay_timeout` for
+        IDs that do not expire (or were accepted while already expired).
+        """
+        timeout = int(math.ceil(expires - time.time())) if expires else 0
+        return timeout if timeout > 0 else self.default_timeout
+
+    def is_used(self, saml_id):
+        """
+        Return True if the ID was used before.
+        """
+        key = self.get_key(saml_id)
+        if self.local.get(key):
+            return True
+        return bool(self.cache_alias) and caches[self.cache_alias].get(key) is not None
+
+    def mark_used(self, saml_id, expires=None):
+        """
+        Store the ID as used until `expires`. Returns False if the ID was
+        already used, True otherwise.
+        """
+        key = self.get_key(saml_id)
+        timeout = self.get_timeout(expires)
+        if not self.local.add(key, True, timeout):
+            return False
+        if self.cache_alias:
+            return caches[self.cache_alias].add(key, True, timeout)
+        return True
+
+
+def get_assertion_store(config):
+    return config.get_or_set('assertion_store', lambda: AssertionStore(config.settings))
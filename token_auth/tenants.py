@@ -0,0 +1,165 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+from django.http.request import split_domain_port
+from django.utils.module_loading import import_string
+
+from token_auth.caches import LRUCache
+from token_auth.exceptions import UnknownTenant
+from token_auth.models import Tenant
+from token_auth.utils import TokenAuthConfig, get_config
+
+TENANT_NAME = re.compile(r'^[\w.-]+$')
+
+# Number of locks that loading tenants is spread over
+LOCK_STRIPES = 64
+
+LoadedConfig = namedtuple('LoadedConfig', ('config', 'loaded'))
+
+
+class SettingsTenantLoader(object):
+    """
+    Loads the settings of tenants from the `tenants` setting, a dict
+    mapping tenant names to their settings.
+    """
+    def __init__(self, settings):
+        self.tenants = settings.get('tenants', {})
+
+    def load(self, tenant):
+        return self.tenants.get(tenant)
+
+
+class DirectoryTenantLoader(object):
+    """
+    Loads the settings of tenants from JSON files named `<tenant>.json` in
+    the directory set with `tenant_directory`.
+    """
+    def __init__(self, settings):
+        self.directory = settings['tenant_directory']
+
+    def load(self, tenant):
+        try:
+            with open(os.path.join(self.directory, tenant + '.json')) as tenant_file:
+                return json.load(tenant_file)
+        except IOError:
+            return None
+
+
+class ModelTenantLoader(object):
+    """
+    Loads the settings of tenants from the active `Tenant` objects.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+
+    def load(self, tenant):
+        try:
+            return json.loads(Tenant.objects.get(name=tenant, is_active=True).settings)
+        except Tenant.DoesNotExist:
+            return None
+
+
+class TenantRegistry(object):
+    """
+    Configurations of tenants, loaded on first use with `loader`.
+
+    The settings of a tenant are the TOKEN_AUTH settings updated with the
+    settings from the loader. Configurations of the `size` most recently
+    used tenants are kept; they are loaded again after `reload_interval`
+    seconds, so changed settings are picked up without a restart. When the
+    settings did not change, the existing configuration (and everything
+    cached on it) is kept. Unknown tenants are remembered for
+    `unknown_timeout` seconds, so requests for them do not hit the loader.
+
+    Tenants are loaded under one of LOCK_STRIPES locks, so a slow loader
+    only holds up requests for some of the other tenants. While a tenant is
+    reloaded, other requests for it keep using its current configuration.
+    """
+    def __init__(self, root, loader, size=100, reload_interval=300, unknown_timeout=60):
+        self.root = root
+        self.loader = loader
+        self.configs = LRUCache(size)
+        self.unknown = LRUCache(size)
+        self.reload_interval = reload_interval
+        self.unknown_timeout = unknown_timeout
+        self._locks = [threading.Lock() for _index in range(LOCK_STRIPES)]
+
+    def get_config(self, tenant):
+        loaded = self.configs.get(tenant)
+        if loaded is not None and loaded.loaded + self.reload_interval > time.time():
+            return loaded.config
+
+        if not TENANT_NAME.match(tenant) or self.unknown.get(tenant):
+            raise UnknownTenant(tenant)
+
+        lock = self._locks[hash(tenant) % LOCK_STRIPES]
+        if not lock.acquire(loaded is None):
+            # Reloaded by another thread, keep using the current configuration meanwhile
+            return loaded.config
+
+        try:
+            current = self.configs.get(tenant)
+            if current is not None and current is not loaded:
+                # Loaded by another thread in the meantime
+                return current.config
+            return self.load(tenant, loaded)
+        finally:
+            lock.release()
+
+    def load(self, tenant, loaded=None):
+        tenant_settings = self.loader.load(tenant)
+        if tenant_settings is None:
+            self.configs.delete(tenant)
+            self.unknown.set(tenant, True, self.unknown_timeout)
+            raise UnknownTenant(tenant)
+
+        config = TokenAuthConfig(dict(self.root.settings, **tenant_settings), root=self.root)
+        if loaded is not None and loaded.config.settings_hash == config.settings_hash:
+            config = loaded.config
+
+        self.configs.set(tenant, LoadedConfig(config, time.time()))
+        return config
+
+
+def get_tenant_registry(config):
+    """
+    Return the TenantRegistry for the `tenant_loader` setting, or None if
+    it is not set.
+    """
+    def create():
+        settings = config.settings
+        if not settings.get('tenant_loader'):
+            return None
+
+        return TenantRegistry(
+            config,
+            import_string(settings['tenant_loader'])(settings),
+            size=settings.get('tenant_cache_size', 100),
+            reload_interval=settings.get('tenant_reload_interval', 300),
+            unknown_timeout=settings.get('tenant_unknown_timeout', 60)
+        )
+
+    return config.get_or_set('tenant_registry', create)
+
+
+def get_request_config(request, tenant=None):
+    """
+    Return the configuration for a request: the one of the tenant (from the
+    URL, or the host name if the `tenant_from` setting is 'host'), or the
+    process wide configuration without tenants.
+    """
+    config = get_config()
+    registry = get_tenant_registry(config)
+    if registry is None:
+        return config
+
+    if tenant is None and config.settings.get('tenant_from') == 'host':
+        tenant, _port = split_domain_port(request.get_host())
+
+    if tenant is None:
+        return config
+    return registry.get_config(tenant)
@@ -0,0 +1,139 @@
+import json
+import os
+import tempfile
+import threading
+
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+from mock import patch
+
+from token_auth.audit import AuditLog, JSONLinesSink, ModelSink, get_audit_log
+from token_auth.exceptions import TokenAuthenticationError
+from token_auth.models import LoginAuditEvent
+from token_auth.utils import get_config
+from token_auth.views import TokenLoginView
+
+
+def get_event(**kwargs):
+    event = {
+        'timestamp': timezone.now(), 'backend': 'TokenAuthentication', 'remote_id': 'test@example.com',
+        'created': False, 'outcome': 'success', 'error_code': None, 'latency': 1.5, 'client_ip': '127.0.0.1'
+    }
+    event.update(kwargs)
+    return event
+
+
+class ListSink(object):
+    def __init__(self, settings=None):
+        self.events = []
+        self.blocked = threading.Event()
+        self.blocked.set()
+
+    def write(self, events):
+        self.blocked.wait()
+        self.events.extend(events)
+
+
+class AuditLogTestCase(TestCase):
+    """
+    Tests buffering audit events
+    """
+    def test_emit(self):
+        sink = ListSink()
+        audit_log = AuditLog(sink, idle_timeout=0.01)
+        for index in range(10):
+            audit_log.emit(index=index)
+        audit_log.flush()
+
+        self.assertEqual([event['index'] for event in sink.events], range(10))
+        self.assertEqual(audit_log.counters.get('written'), 10)
+
+    def test_drop_when_full(self):
+        sink = ListSink()
+        sink.blocked.clear()
+        audit_log = AuditLog(sink, buffer_size=2, batch_size=1, idle_timeout=0.01)
+
+        for index in range(10):
+            audit_log.emit(index=index)
+        sink.blocked.set()
+        audit_log.flush()
+
+        # One event taken by the (blocked) thread, two buffered
+        self.assertTrue(audit_log.counters.get('dropped') >= 7)
+        self.assertEqual(len(sink.events) + audit_log.counters.get('dropped'), 10)
+
+    @patch('token_auth.audit.logger')
+    def test_failing_sink(self, logger):
+        sink = ListSink()
+        audit_log = AuditLog(sink, idle_timeout=0.01)
+        with patch.object(sink, 'write', side_effect=IOError):
+            audit_log.emit(index=1)
+            audit_log.flush()
+
+        self.assertEqual(audit_log.counters.get('failed'), 1)
+        self.assertEqual(logger.exception.call_count, 1)
+
+    def test_disabled(self):
+        with self.settings(TOKEN_AUTH={}):
+            self.assertEqual(get_audit_log(get_config()), None)
+
+
+class SinkTestCase(TestCase):
+    """
+    Tests writing audit events
+    """
+    def test_jsonl(self):
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        try:
+            JSONLinesSink({'audit_file': path}).write([get_event(), get_event(outcome='error', error_code='used')])
+            with open(path) as audit_file:
+                events = [json.loads(line) for line in audit_file]
+        finally:
+            os.remove(path)
+
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[1]['error_code'], 'used')
+
+    def test_model(self):
+        with self.assertNumQueries(1):
+            ModelSink({}).write([get_event(), get_event(outcome='error', error_code='used')])
+
+        self.assertEqual(LoginAuditEvent.objects.filter(outcome='error', error_code='used').count(), 1)
+
+
+class AuditLoginViewTestCase(TestCase):
+    """
+    Tests the audit events of the login view
+    """
+    token_auth = {'backend': 'token_auth.tests.test_views.DummyAuthentication',
+                  'audit_sink': 'token_auth.tests.test_audit.ListSink'}
+
+    def get_events(self):
+        audit_log = get_audit_log(get_config())
+        audit_log.flush()
+        return audit_log.sink.events
+
+    def test_success(self):
+        with self.settings(TOKEN_AUTH=self.token_auth):
+            TokenLoginView().get(RequestFactory().get('/api/sso/authenticate', REMOTE_ADDR='10.0.0.1'))
+            events = self.get_events()
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['outcome'], 'success')
+        self.assertEqual(events[0]['created'], True)
+        self.assertEqual(events[0]['backend'], 'DummyAuthentication')
+        self.assertEqual(events[0]['client_ip'], '10.0.0.1')
+        self.assertTrue(events[0]['latency'] >= 0)
+
+    @patch('token_auth.tests.test_views.DummyAuthentication.authenticate',
+           side_effect=TokenAuthenticationError('used', code='used'))
+    def test_error(self, authenticate):
+        with self.settings(TOKEN_AUTH=self.token_auth):
+            TokenLoginView().get(RequestFactory().get('/api/sso/authenticate'), token='used-token')
+            # Rejected from the rejected token cache
+            TokenLoginView().get(RequestFactory().get('/api/sso/authenticate'), token='used-token')
+            events = self.get_events()
+
+        self.assertEqual([(event['outcome'], event['error_code']) for event in events],
+                         [('error', 'used'), ('error', 'used')])
@@ -1,8 +1,13 @@
+import time
+
 from mock import patch
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth import get_user_model
+from django.db import transaction
 
 from token_auth.auth.base import BaseTokenAuthentication
+from token_auth.deferred import DeferredWrites, close_all, get_deferred_writes
+from token_auth.utils import get_config
 
 
 class TestBaseTokenAuthentication(TestCase):
@@ -57,3 +62,176 @@ class TestBaseTokenAuthentication(TestCase):
             self.assertFalse(created)
             self.assertEqual(user.email, 'test@example.com')
             self.assertEqual(user.first_name, 'updated')
+
+    def test_user_unchanged_not_saved(self):
+        with self.settings(TOKEN_AUTH={}, AUTH_USER_MODEL='tests.TestUser'):
+            get_user_model()(remote_id='test@example.com', email='test@example.com', first_name='test').save()
+
+            # Only the select, in a savepoint
+            with self.assertNumQueries(3):
+                user, created = self.auth.get_or_create_user(
+                    {'remote_id': 'test@example.com', 'email': 'test@example.com', 'first_name': 'test'}
+                )
+
+            self.assertFalse(created)
+
+    def test_user_case_insensitive_remote_id(self):
+        with self.settings(TOKEN_AUTH={}, AUTH_USER_MODEL='tests.TestUser'):
+            existing = get_user_model().objects.create(remote_id='TEST@example.com', email='test@example.com')
+
+            user, created = self.auth.get_or_create_user(
+                {'remote_id': 'test@example.com', 'email': 'test@example.com'}
+            )
+
+            self.assertFalse(created)
+            self.assertEqual(user.pk, existing.pk)
+            self.assertEqual(get_user_model().objects.get(pk=existing.pk).remote_id, 'test@example.com')
+
+    def test_user_created_concurrently(self):
+        with self.settings(TOKEN_AUTH={}, AUTH_USER_MODEL='tests.TestUser'):
+            existing = get_user_model().objects.create(remote_id='test@example.com', email='test@example.com')
+
+            with patch.object(BaseTokenAuthentication, 'get_user', side_effect=[None, existing]):
+                user, created = self.auth.get_or_create_user(
+                    {'remote_id': 'test@example.com', 'email': 'test@example.com', 'first_name': 'updated'}
+                )
+
+            self.assertFalse(created)
+            self.assertEqual(user.pk, existing.pk)
+            self.assertEqual(get_user_model().objects.get(pk=existing.pk).first_name, 'updated')
+
+    def test_get_user_data(self):
+        with self.settings(TOKEN_AUTH={}, AUTH_USER_MODEL='tests.TestUser'):
+            auth = BaseTokenAuthentication(None)
+
+            self.assertEqual(
+                auth.get_user_data({'email': 'test@example.com', 'timestamp': '2013-12-23', 'id': 1}),
+                {'email': 'test@example.com'}
+            )
+            self.assertIs(auth.get_user_fields(), BaseTokenAuthentication(None).get_user_fields())
+
+    def test_get_user_data_whitelist(self):
+        with self.settings(TOKEN_AUTH={'user_fields': ['email', 'remote_id']}, AUTH_USER_MODEL='tests.TestUser'):
+            auth = BaseTokenAuthentication(None)
+
+            self.assertEqual(
+                auth.get_user_data({'email': 'test@example.com', 'first_name': 'Test', 'remote_id': 'test'}),
+                {'email': 'test@example.com', 'remote_id': 'test'}
+            )
+
+    def test_whitelist_logins(self):
+        # Without remote_id the second login would create the user again
+        with self.settings(TOKEN_AUTH={'user_fields': ['email']}, AUTH_USER_MODEL='tests.TestUser'):
+            auth = BaseTokenAuthentication(None)
+            data = {'remote_id': 'test@example.com', 'email': 'test@example.com', 'is_active': True}
+
+            user, created = auth.get_or_create_user(data)
+            self.assertTrue(created)
+            self.assertEqual(user.remote_id, 'test@example.com')
+            self.assertTrue(user.is_active)
+
+            self.assertEqual(auth.get_or_create_user(data), (user, False))
+
+    def test_get_user_data_mapping(self):
+        with self.settings(TOKEN_AUTH={'user_field_mapping': {'mail': 'email'}}, AUTH_USER_MODEL='tests.TestUser'):
+            auth = BaseTokenAuthentication(None)
+
+            self.assertEqual(
+                auth.get_user_data({'mail': 'test@example.com', 'first_name': 'Test'}),
+                {'email': 'test@example.com', 'first_name': 'Test'}
+            )
+
+
+class SynchronousPool(object):
+    """
+    Runs the tasks right away, as the in-memory test database can not be
+    used from other threads.
+    """
+    def __init__(self, threads):
+        pass
+
+    def apply_async(self, func, args):
+        func(*args)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+@patch('token_auth.deferred.ThreadPool', SynchronousPool)
+class TestDeferredWrites(TransactionTestCase):
+    """
+    Tests updating the user in the background.
+    """
+    def test_user_updated_after_commit(self):
+        with self.settings(TOKEN_AUTH={'deferred_writes': True}, AUTH_USER_MODEL='tests.TestUser'):
+            existing = get_user_model().objects.create(remote_id='test@example.com', first_name='test')
+
+            with transaction.atomic():
+                user, created = BaseTokenAuthentication(None).get_or_create_user(
+                    {'remote_id': 'test@example.com', 'first_name': 'updated'}
+                )
+
+                self.assertFalse(created)
+                self.assertEqual(user.first_name, 'updated')
+                self.assertEqual(get_user_model().objects.get(pk=existing.pk).first_name, 'test')
+
+            self.assertEqual(get_user_model().objects.get(pk=existing.pk).first_name, 'updated')
+
+    def test_rolled_back(self):
+        with self.settings(TOKEN_AUTH={'deferred_writes': True}, AUTH_USER_MODEL='tests.TestUser'):
+            existing = get_user_model().objects.create(remote_id='test@example.com', first_name='test')
+
+            try:
+                with transaction.atomic():
+                    BaseTokenAuthentication(None).get_or_create_user(
+                        {'remote_id': 'test@example.com', 'first_name': 'updated'}
+                    )
+                    raise ValueError()
+            except ValueError:
+                pass
+
+            self.assertEqual(get_user_model().objects.get(pk=existing.pk).first_name, 'test')
+
+    def test_disabled(self):
+        with self.settings(TOKEN_AUTH={}):
+            self.assertEqual(get_deferred_writes(get_config()), None)
+
+
+class TestDeferredWritesPool(TransactionTestCase):
+    """
+    Tests running deferred writes in background threads.
+    """
+    def test_submit(self):
+        results = []
+        deferred_writes = DeferredWrites(2)
+        for index in range(10):
+            deferred_writes.submit(results.append, index)
+        deferred_writes.close()
+
+        self.assertEqual(sorted(results), range(10))
+
+    @patch('token_auth.deferred.logger')
+    def test_failing_write(self, logger):
+        deferred_writes = DeferredWrites(1)
+        deferred_writes.submit(int, 'not a number')
+        deferred_writes.close()
+
+        self.assertEqual(logger.exception.call_count, 1)
+
+    def test_close_all(self):
+        results = []
+
+        def slow_append(value):
+            time.sleep(0.01)
+            results.append(value)
+
+        deferred_writes = DeferredWrites(1)
+        for index in range(5):
+            deferred_writes.submit(slow_append, index)
+        # Like on exit
+        close_all()
+
+        self.assertEqual(results, range(5))
@@ -1,20 +1,29 @@
 import base64
+import csv
 import hashlib
 import hmac
+import json
+import tempfile
+import time
 from datetime import datetime, timedelta
+from StringIO import StringIO
 from Crypto.Cipher import AES
 from Crypto import Random
 import mock
 
 from django.test.testcases import TestCase
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import RequestFactory
 
 from token_auth.exceptions import TokenAuthenticationError
-from token_auth.auth.booking import TokenAuthentication
+from token_auth.auth.booking import (
+    TokenAuthentication, generate_tokens, get_key_material, parse_login_data, unpad
+)
 
-from token_auth.models import CheckedToken
+from token_auth.models import CheckedToken, get_token_hash
 from .factories import CheckedTokenFactory
 
 
@@ -143,6 +152,26 @@ class TestBookingTokenAuthentication(TestCase):
                 'john.doe@example.com'
             ))
 
+    def test_parse_login_data_padded(self):
+        """
+        Tests that the PKCS#7 padding is stripped from the message.
+        """
+        login_data = parse_login_data(self.data + '\x04' * 4)
+
+        self.assertEqual(login_data.email, 'john.doe@example.com')
+        self.assertEqual(login_data.name, 'John Doe')
+
+    def test_parse_login_data_invalid(self):
+        self.assertIsNone(parse_login_data('time=2013-12-23 17:51:15|username=johndoe'))
+        self.assertIsNone(parse_login_data(''))
+
+    def test_unpad(self):
+        self.assertEqual(unpad('message' + '\x09' * 9), 'message')
+        self.assertEqual(unpad('message' + '\x10' * 16), 'message')
+        # Not padded correctly
+        self.assertEqual(unpad('message\x02'), 'message\x02')
+        self.assertEqual(unpad('message\x00'), 'message\x00')
+
     def test_check_timestamp_valid_token(self):
         """
         Tests the method to check the login message timestamp when a good
@@ -184,13 +213,70 @@ class TestBookingTokenAuthentication(TestCase):
         token is provided.
         """
         with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
-            auth_backend = TokenAuthentication(self.request, token=self.checked_token.token)
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            message = 'time={0}|username=johndoe|name=John Doe|' \
+                      'email=john.doe@example.com'.format(timestamp)
+            aes_message, hmac_digest = self._encode_message(message)
+            token = base64.urlsafe_b64encode(aes_message + hmac_digest.digest())
+            CheckedTokenFactory.create(token=token, user=self.checked_token.user)
+
+            auth_backend = TokenAuthentication(self.request, token=token)
 
             self.assertRaisesMessage(
                 TokenAuthenticationError,
                 'Token was already used and is not valid',
                 auth_backend.authenticate)
 
+            # Remembered as rejected until the token expires
+            with self.assertRaises(TokenAuthenticationError) as context:
+                auth_backend.authenticate()
+            self.assertAlmostEqual(
+                context.exception.expires, time.time() + TOKEN_AUTH_SETTINGS['token_expiration'], delta=2
+            )
+
+    def test_authenticate_fail_used_token_expired(self):
+        """
+        Tests that expired tokens are rejected before checking if they were
+        used, without querying the database.
+        """
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            auth_backend = TokenAuthentication(self.request, token=self.checked_token.token)
+
+            with self.assertNumQueries(0):
+                self.assertRaisesMessage(
+                    TokenAuthenticationError,
+                    'Authentication token expired',
+                    auth_backend.authenticate_request)
+
+    def test_authenticate_fail_malformed_token(self):
+        """
+        Tests that tokens that can not be valid are rejected before checking
+        the signature.
+        """
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            for token in ('not a token', 'dG9vIHNob3J0', u'\u2026', self.token[:-8], 'a' * 5000):
+                auth_backend = TokenAuthentication(self.request, token=token)
+
+                with mock.patch.object(TokenAuthentication, 'check_hmac_signature') as check_hmac_signature:
+                    self.assertRaisesMessage(
+                        TokenAuthenticationError,
+                        'Malformed token',
+                        auth_backend.authenticate_request)
+                    self.assertFalse(check_hmac_signature.called)
+
+    def test_rejections_counted(self):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            TokenAuthentication.rejections.reset()
+
+            for token in ('not a token', self.corrupt_token, self.corrupt_token, self.checked_token.token):
+                auth_backend = TokenAuthentication(self.request, token=token)
+                self.assertRaises(TokenAuthenticationError, auth_backend.authenticate_request)
+
+            self.assertEqual(
+                TokenAuthentication.rejections.as_dict(),
+                {'malformed': 1, 'hmac': 2, 'expired': 1}
+            )
+
     def test_authenticate_fail_corrupted_token(self):
         """
         Tests that ``authenticate`` method raises an exception when a corrupt
@@ -263,6 +349,30 @@ class TestBookingTokenAuthentication(TestCase):
             self.assertEqual(checked_token.token, token)
             self.assertEqual(checked_token.user.username, user.username)
 
+    def test_checked_token_hash(self):
+        """
+        Tests that used tokens are stored and looked up by their digest.
+        """
+        self.assertEqual(self.checked_token.token_hash, get_token_hash(self.checked_token.token))
+        self.assertTrue(CheckedToken.objects.is_used(self.checked_token.token))
+        self.assertFalse(CheckedToken.objects.is_used(self.token))
+
+    def test_finalize_token_used_concurrently(self):
+        """
+        Tests that ``finalize`` rejects a token that was stored after the
+        replay check of this request passed.
+        """
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            auth_backend = TokenAuthentication(self.request, token=self.checked_token.token)
+
+            self.assertRaisesMessage(
+                TokenAuthenticationError,
+                'Token was already used and is not valid',
+                auth_backend.finalize,
+                self.checked_token.user,
+                {'timestamp': '2013-12-23 17:51:15'})
+            self.assertEqual(CheckedToken.objects.count(), 1)
+
     @mock.patch.object(get_user_model(), 'get_login_token', create=True, return_value='tralala')
     def test_login_view(self, get_jwt_token):
         """
@@ -317,3 +427,117 @@ class TestBookingTokenAuthentication(TestCase):
                 response['Location'],
                 "https://example.org?url=%2Fprojects%2Fmy-project"
             )
+
+
+class TestKeyMaterial(TestCase):
+    """
+    Tests the prepared AES and HMAC keys.
+    """
+    def test_shared(self):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            request = RequestFactory().get('/api/sso/redirect')
+            keys = TokenAuthentication(request, token='a').keys
+
+            self.assertIs(keys, get_key_material())
+            self.assertIs(keys, TokenAuthentication(request, token='b').keys)
+
+    def test_sign(self):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            keys = get_key_material()
+
+            self.assertEqual(
+                keys.sign('message').digest(),
+                hmac.new(TOKEN_AUTH_SETTINGS['hmac_key'], 'message', hashlib.sha1).digest()
+            )
+            self.assertEqual(
+                keys.sign('other message').digest(),
+                hmac.new(TOKEN_AUTH_SETTINGS['hmac_key'], 'other message', hashlib.sha1).digest()
+            )
+
+    def test_invalid_aes_key(self):
+        with self.settings(TOKEN_AUTH=dict(TOKEN_AUTH_SETTINGS, aes_key='too short')):
+            self.assertRaises(ImproperlyConfigured, get_key_material)
+
+    def test_empty_hmac_key(self):
+        with self.settings(TOKEN_AUTH=dict(TOKEN_AUTH_SETTINGS, hmac_key='')):
+            self.assertRaises(ImproperlyConfigured, get_key_material)
+
+
+class TestGenerateTokens(TestCase):
+    """
+    Tests generating tokens in batches.
+    """
+    def test_generate_tokens(self):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            records = [
+                ('user-{0}@example.com'.format(index), 'user-{0}'.format(index), 'User', str(index))
+                for index in range(5)
+            ]
+            tokens = list(generate_tokens(iter(records), chunk_size=2))
+
+            self.assertEqual(len(set(tokens)), 5)
+            for index, token in enumerate(tokens):
+                data = TokenAuthentication(RequestFactory().get('/'), token=token).decrypt_message()
+                self.assertEqual(data['email'], 'user-{0}@example.com'.format(index))
+                self.assertEqual(data['last_name'], str(index))
+
+    def test_command(self):
+        input_file = tempfile.NamedTemporaryFile(suffix='.jsonl')
+        input_file.write(json.dumps({'email': 'john.doe@example.com', 'first_name': 'John'}) + '\n')
+        input_file.write(json.dumps({'email': 'jane@example.com'}) + '\n')
+        input_file.flush()
+        output_file = tempfile.NamedTemporaryFile(suffix='.jsonl')
+
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            call_command('generate_auth_token', input=input_file.name, output=output_file.name, stderr=StringIO())
+
+            rows = [json.loads(line) for line in open(output_file.name)]
+            self.assertEqual([row['email'] for row in rows], ['john.doe@example.com', 'jane@example.com'])
+
+            data = TokenAuthentication(RequestFactory().get('/'), token=rows[1]['token']).decrypt_message()
+            self.assertEqual(data['first_name'], 'Jane')
+            self.assertEqual(data['last_name'], 'Example')
+
+    def test_command_non_ascii(self):
+        input_file = tempfile.NamedTemporaryFile(suffix='.csv')
+        input_file.write(u'email,first_name,last_name\njose@example.com,Jos\xe9,Mu\xf1oz\n'.encode('utf-8'))
+        input_file.flush()
+        output_file = tempfile.NamedTemporaryFile(suffix='.csv')
+
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            call_command('generate_auth_token', input=input_file.name, output=output_file.name, stderr=StringIO())
+
+            rows = list(csv.DictReader(open(output_file.name)))
+            self.assertEqual(rows[0]['first_name'].decode('utf-8'), u'Jos\xe9')
+
+            data = TokenAuthentication(RequestFactory().get('/'), token=rows[0]['token']).decrypt_message()
+            self.assertEqual(data['first_name'].decode('utf-8'), u'Jos\xe9')
+            self.assertEqual(data['last_name'].decode('utf-8'), u'Mu\xf1oz')
+
+    def test_command_invalid_rows(self):
+        input_file = tempfile.NamedTemporaryFile(suffix='.csv')
+        input_file.write('email,first_name\njohn@example.com,John\nno-at-sign,X\n\nshort\njane@example.com\n')
+        input_file.flush()
+        output_file = tempfile.NamedTemporaryFile(suffix='.csv')
+        stderr = StringIO()
+
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            call_command('generate_auth_token', input=input_file.name, output=output_file.name, stderr=stderr)
+
+        rows = list(csv.DictReader(open(output_file.name)))
+        self.assertEqual([row['email'] for row in rows], ['john@example.com', 'jane@example.com'])
+        self.assertIn('Skipped line 3: invalid email no-at-sign', stderr.getvalue())
+        self.assertIn('Skipped line 5: invalid email short', stderr.getvalue())
+        self.assertIn('Skipped 2 invalid rows', stderr.getvalue())
+
+    def test_command_missing_email(self):
+        input_file = tempfile.NamedTemporaryFile(suffix='.jsonl')
+        input_file.write(json.dumps({'first_name': 'John'}) + '\n' + json.dumps(['x']) + '\n')
+        input_file.flush()
+        stderr = StringIO()
+
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            call_command('generate_auth_token', input=input_file.name, stdout=StringIO(), stderr=stderr)
+
+        self.assertIn('Skipped line 1: no email', stderr.getvalue())
+        self.assertIn('Skipped line 2: not an object', stderr.getvalue())
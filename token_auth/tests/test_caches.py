@@ -0,0 +1,93 @@
+import time
+
+from django.test import SimpleTestCase
+from mock import patch
+
+from token_auth.caches import LRUCache, RejectedTokenCache
+from token_auth.exceptions import TokenAuthenticationError
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    """
+    Tests the bounded in-process cache
+    """
+    def test_get_set(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 2), 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+
+    @patch('token_auth.caches.time.time')
+    def test_timeout(self, time):
+        time.return_value = 1000
+        cache = LRUCache(2)
+        cache.set('a', 1, timeout=10)
+
+        time.return_value = 1011
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_add(self):
+        cache = LRUCache(2)
+
+        self.assertTrue(cache.add('a', 1))
+        self.assertFalse(cache.add('a', 2))
+        self.assertEqual(cache.get('a'), 1)
+
+
+class RejectedTokenCacheTestCase(SimpleTestCase):
+    """
+    Tests remembering rejected tokens
+    """
+    def test_add_get(self):
+        rejected = RejectedTokenCache({})
+        rejected.add('token', TokenAuthenticationError('Token expired', code='expired'))
+
+        error = rejected.get('token')
+        self.assertEqual(error.value, 'Token expired')
+        self.assertEqual(error.code, 'expired')
+        self.assertEqual(rejected.get('other-token'), None)
+
+    def test_permanent_only(self):
+        rejected = RejectedTokenCache({})
+        rejected.add('token', TokenAuthenticationError('Too busy', code='saturated'))
+
+        self.assertEqual(rejected.get('token'), None)
+
+    def test_token_expires(self):
+        rejected = RejectedTokenCache({'token_expiration': 600})
+        rejected.add('token', TokenAuthenticationError('Token used', code='used', expires=time.time() + 60))
+        rejected.add('expired', TokenAuthenticationError('Token used', code='used', expires=time.time() - 1))
+
+        value, expires = rejected.local._items[rejected.get_key('token')]
+        self.assertLessEqual(expires, time.time() + 60)
+        self.assertEqual(rejected.get('expired'), None)
+
+    def test_django_cache(self):
+        settings = {'rejected_token_cache': 'default'}
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            RejectedTokenCache(settings).add('token', TokenAuthenticationError('Token used', code='used'))
+
+            # Another process only shares the Django cache
+            error = RejectedTokenCache(settings).get('token')
+
+        self.assertEqual(error.code, 'used')
+
+    def test_disabled(self):
+        rejected = RejectedTokenCache({'rejected_token_cache_size': 0})
+        rejected.add('token', TokenAuthenticationError('Token used', code='used'))
+
+        self.assertEqual(rejected.get('token'), None)
@@ -0,0 +1,319 @@
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, TestCase
+from mock import patch
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+from token_auth.auth.saml import SAMLAuthentication
+from token_auth.exceptions import IdPMetadataError, TokenAuthenticationError
+from token_auth.idp_metadata import (
+    IdPMetadata, check_metadata_signature, get_idp_metadata, get_idp_settings, parse_idp_metadata
+)
+from token_auth.utils import get_config
+
+from .saml_settings import TOKEN_AUTH_SETTINGS
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+METADATA_PATH = os.path.join(DATA_DIR, 'idp_metadata.xml')
+
+with open(METADATA_PATH) as metadata_file:
+    METADATA = metadata_file.read()
+
+CURRENT_CERT = TOKEN_AUTH_SETTINGS['idp']['x509cert']
+
+
+class ParseIdPMetadataTestCase(TestCase):
+    """
+    Tests parsing IdP metadata into SAML settings
+    """
+    @patch('token_auth.idp_metadata.OneLogin_Saml2_Utils.parse_duration', return_value=1800000000)
+    def test_parse(self, parse_duration):
+        metadata = parse_idp_metadata(METADATA)
+        idp = metadata['idp']
+
+        self.assertEqual(idp['entityId'], 'http://idp.example.com/')
+        self.assertEqual(idp['singleSignOnService']['url'], 'https://idp.example.com/sso')
+        self.assertEqual(idp['singleLogoutService']['url'], 'https://idp.example.com/slo')
+
+        # The signing certificates, without whitespace, and not the encryption certificate
+        self.assertEqual(len(idp['x509certMulti']['signing']), 2)
+        self.assertEqual(idp['x509certMulti']['signing'][1], CURRENT_CERT)
+        self.assertEqual(idp['x509cert'], idp['x509certMulti']['signing'][0])
+
+        # The cacheDuration of the entity, as it is earlier than the validUntil around it
+        parse_duration.assert_called_with('PT6H')
+        self.assertEqual(metadata['valid_until'], 1800000000)
+
+    @patch('token_auth.idp_metadata.OneLogin_Saml2_Utils.parse_duration', return_value=1900000000)
+    def test_valid_until(self, parse_duration):
+        metadata = parse_idp_metadata(METADATA)
+
+        self.assertEqual(metadata['valid_until'], OneLogin_Saml2_Utils.parse_SAML_to_time('2030-01-01T00:00:00Z'))
+
+    def test_post_binding(self):
+        metadata = parse_idp_metadata(METADATA, binding='urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST')
+
+        self.assertEqual(metadata['idp']['singleSignOnService']['url'], 'https://idp.example.com/sso/post')
+        self.assertNotIn('singleLogoutService', metadata['idp'])
+
+    def test_entity_id(self):
+        self.assertEqual(
+            parse_idp_metadata(METADATA, entity_id='http://idp.example.com/')['idp']['entityId'],
+            'http://idp.example.com/'
+        )
+        self.assertRaises(IdPMetadataError, parse_idp_metadata, METADATA, entity_id='http://sp.example.com/')
+
+    def test_invalid(self):
+        self.assertRaises(IdPMetadataError, parse_idp_metadata, '<md:EntityDescriptor')
+        self.assertRaises(IdPMetadataError, parse_idp_metadata, METADATA.replace('X509Certificate', 'X509Other'))
+        self.assertRaises(
+            IdPMetadataError, parse_idp_metadata, '<!DOCTYPE x [<!ENTITY a "a">]>' + METADATA.split('?>', 1)[1]
+        )
+
+
+def get_signed_metadata():
+    """
+    The IdP of the test metadata as a document of its own, signed with the
+    test metadata signing key.
+    """
+    entity = '<md:EntityDescriptor xmlns:md="{0}" xmlns:ds="{1}" {2}'.format(
+        'urn:oasis:names:tc:SAML:2.0:metadata', 'http://www.w3.org/2000/09/xmldsig#',
+        METADATA.split('<md:EntityDescriptor ')[2].split('</md:EntitiesDescriptor>')[0]
+    )
+    with open(os.path.join(DATA_DIR, 'idp_metadata_signing.key')) as key_file:
+        return entity, OneLogin_Saml2_Utils.add_sign(entity, key_file.read(), SIGNING_CERT)
+
+
+with open(os.path.join(DATA_DIR, 'idp_metadata_signing.crt')) as cert_file:
+    SIGNING_CERT = cert_file.read()
+
+
+class MetadataSignatureTestCase(TestCase):
+    """
+    Tests only loading IdP metadata from trusted sources
+    """
+    def setUp(self):
+        self.unsigned, self.signed = get_signed_metadata()
+
+    def test_signed(self):
+        check_metadata_signature(self.signed, SIGNING_CERT)
+
+        self.assertRaises(IdPMetadataError, check_metadata_signature, self.unsigned, SIGNING_CERT)
+        self.assertRaises(IdPMetadataError, check_metadata_signature, self.signed, CURRENT_CERT)
+        self.assertRaises(
+            IdPMetadataError, check_metadata_signature,
+            self.signed.replace('https://idp.example.com/sso"', 'https://evil.example.com/sso"'), SIGNING_CERT
+        )
+        # Only part of the document signed
+        partial = self.signed.replace('<ds:Reference', '<ds:Reference URI="#part"')
+        self.assertRaises(IdPMetadataError, check_metadata_signature, partial, SIGNING_CERT)
+
+    @patch('token_auth.idp_metadata.urllib2.urlopen')
+    def test_http(self, urlopen):
+        urlopen.return_value.read.return_value = self.signed
+        settings = dict(TOKEN_AUTH_SETTINGS, idp_metadata='http://idp.example.com/metadata')
+
+        with self.assertRaisesRegexp(IdPMetadataError, 'over http'):
+            IdPMetadata(settings).fetch()
+        self.assertFalse(urlopen.called)
+
+        metadata = IdPMetadata(dict(settings, idp_metadata_cert=SIGNING_CERT)).fetch()
+        self.assertEqual(metadata['idp']['entityId'], 'http://idp.example.com/')
+
+        urlopen.return_value.read.return_value = self.unsigned
+        self.assertRaises(IdPMetadataError, IdPMetadata(dict(settings, idp_metadata_cert=SIGNING_CERT)).fetch)
+
+    def test_file(self):
+        # Files are trusted, unless a certificate is set
+        settings = dict(TOKEN_AUTH_SETTINGS, idp_metadata=METADATA_PATH)
+        self.assertEqual(IdPMetadata(settings).fetch()['idp']['entityId'], 'http://idp.example.com/')
+        self.assertRaises(IdPMetadataError, IdPMetadata(dict(settings, idp_metadata_cert=SIGNING_CERT)).fetch)
+
+
+class IdPMetadataTestCase(TestCase):
+    """
+    Tests loading, caching and refreshing IdP metadata
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings_dict = dict(
+            TOKEN_AUTH_SETTINGS, idp_metadata=METADATA_PATH,
+            idp_metadata_cache=os.path.join(self.directory, 'idp.json')
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        idp_metadata = IdPMetadata(self.settings_dict)
+        settings_hash, settings = idp_metadata.get_settings()
+
+        self.assertEqual(settings['idp']['singleSignOnService']['url'], 'https://idp.example.com/sso')
+        self.assertEqual(settings['sp'], TOKEN_AUTH_SETTINGS['sp'])
+        self.assertEqual(idp_metadata.get_settings(), (settings_hash, settings))
+
+        # A new process uses the cache file
+        with patch.object(IdPMetadata, 'fetch') as fetch:
+            self.assertEqual(IdPMetadata(self.settings_dict).get_settings()[0], settings_hash)
+            self.assertFalse(fetch.called)
+
+        # Unless it is for another source
+        with open(self.settings_dict['idp_metadata_cache']) as cache_file:
+            self.assertEqual(json.load(cache_file)['source'], METADATA_PATH)
+        self.assertEqual(IdPMetadata(dict(self.settings_dict, idp_metadata='/other.xml')).read_cache(), None)
+
+    def test_missing(self):
+        idp_metadata = IdPMetadata(dict(self.settings_dict, idp_metadata=os.path.join(self.directory, 'missing.xml')))
+
+        with patch.object(IdPMetadata, 'fetch', side_effect=IdPMetadataError('Could not load')) as fetch:
+            self.assertRaises(IdPMetadataError, idp_metadata.get_settings)
+            # Not loaded again right away
+            with self.assertRaisesRegexp(IdPMetadataError, 'retrying in'):
+                idp_metadata.get_settings()
+            self.assertEqual(fetch.call_count, 1)
+
+            idp_metadata.retry_at = 0
+            self.assertRaises(IdPMetadataError, idp_metadata.get_settings)
+            self.assertEqual(fetch.call_count, 2)
+
+    @patch('token_auth.idp_metadata.time.time', return_value=1000)
+    def test_is_due(self, time):
+        idp_metadata = IdPMetadata(dict(self.settings_dict, idp_metadata_refresh=60))
+
+        self.assertFalse(idp_metadata.is_due({'fetched': 1000, 'valid_until': None}))
+        self.assertTrue(idp_metadata.is_due({'fetched': 940, 'valid_until': None}))
+        self.assertTrue(idp_metadata.is_due({'fetched': 1000, 'valid_until': 1000}))
+
+        idp_metadata.refresh_interval = 0
+        self.assertFalse(idp_metadata.is_due({'fetched': 0, 'valid_until': None}))
+        self.assertFalse(idp_metadata.is_due({'fetched': 0, 'valid_until': 1001}))
+        self.assertTrue(idp_metadata.is_due({'fetched': 0, 'valid_until': 1000}))
+
+    def test_refresh_in_background(self):
+        idp_metadata = IdPMetadata(self.settings_dict)
+        settings_hash, settings = idp_metadata.get_settings()
+
+        with open(self.settings_dict['idp_metadata_cache'], 'w') as cache_file:
+            json.dump(dict(idp_metadata.state.metadata, fetched=0), cache_file)
+        idp_metadata.state = idp_metadata.state._replace(metadata=dict(idp_metadata.state.metadata, fetched=0))
+        idp_metadata.retry_at = 0
+
+        with patch('token_auth.idp_metadata.parse_idp_metadata') as parse:
+            parse.return_value = {
+                'idp': dict(settings['idp'], x509cert=CURRENT_CERT, x509certMulti={'signing': [CURRENT_CERT]}),
+                'valid_until': None
+            }
+            # The current settings are used until the refresh is done
+            self.assertEqual(idp_metadata.get_settings()[0], settings_hash)
+            idp_metadata.thread.join()
+
+        new_hash, new_settings = idp_metadata.get_settings()
+        self.assertNotEqual(new_hash, settings_hash)
+        self.assertEqual(new_settings['idp']['x509certMulti']['signing'], [CURRENT_CERT])
+        self.assertEqual(IdPMetadata(self.settings_dict).get_settings()[0], new_hash)
+
+    def test_refresh_expired(self):
+        idp_metadata = IdPMetadata(self.settings_dict)
+        settings = idp_metadata.get_settings()[1]
+
+        with patch('token_auth.idp_metadata.parse_idp_metadata') as parse:
+            # Already expired at the source
+            parse.return_value = {'idp': settings['idp'], 'valid_until': 1}
+            idp_metadata.state = idp_metadata.state._replace(metadata=dict(idp_metadata.state.metadata, fetched=0))
+            idp_metadata.cache_path = None
+            idp_metadata.retry_at = 0
+
+            for _index in range(50):
+                idp_metadata.get_settings()
+                idp_metadata.thread.join()
+
+            self.assertEqual(parse.call_count, 1)
+
+    @patch('token_auth.idp_metadata.logger')
+    def test_refresh_failed(self, logger):
+        idp_metadata = IdPMetadata(self.settings_dict)
+        state = idp_metadata.load()
+        idp_metadata.state = state._replace(metadata=dict(state.metadata, fetched=0, valid_until=1))
+        idp_metadata.source = os.path.join(self.directory, 'missing.xml')
+        idp_metadata.retry_at = 0
+
+        idp_metadata.get_settings()
+        idp_metadata.thread.join()
+
+        self.assertTrue(logger.exception.called)
+        self.assertTrue(logger.error.called)
+        self.assertEqual(idp_metadata.get_settings(), (state.settings_hash, state.settings))
+        # Not retried right away
+        self.assertFalse(idp_metadata.thread.is_alive())
+        self.assertGreater(idp_metadata.retry_at, 0)
+
+    def test_get_idp_settings(self):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            self.assertEqual(get_idp_metadata(get_config()), None)
+            self.assertEqual(get_idp_settings(get_config()), (get_config().settings_hash, TOKEN_AUTH_SETTINGS))
+
+        with self.settings(TOKEN_AUTH=self.settings_dict):
+            settings_hash, settings = get_idp_settings(get_config())
+            self.assertNotEqual(settings_hash, get_config().settings_hash)
+            self.assertEqual(settings['idp']['singleSignOnService']['url'], 'https://idp.example.com/sso')
+
+    def test_command(self):
+        out = StringIO()
+        with self.settings(TOKEN_AUTH=self.settings_dict):
+            call_command('refresh_idp_metadata', stdout=out)
+
+        self.assertIn('Loaded http://idp.example.com/ with 2 signing certificate(s)', out.getvalue())
+        self.assertEqual(IdPMetadata(self.settings_dict).read_cache()['idp']['entityId'], 'http://idp.example.com/')
+
+    def test_command_errors(self):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            self.assertRaises(CommandError, call_command, 'refresh_idp_metadata', stdout=StringIO())
+
+        with self.settings(TOKEN_AUTH=dict(self.settings_dict, idp_metadata='/missing.xml')):
+            self.assertRaises(CommandError, call_command, 'refresh_idp_metadata', stdout=StringIO())
+
+        out = StringIO()
+        with self.settings(TOKEN_AUTH=dict(self.settings_dict, idp_metadata_cache=None)):
+            self.assertRaises(CommandError, call_command, 'refresh_idp_metadata', stdout=StringIO())
+            call_command('refresh_idp_metadata', stdout=out, **{'dry-run': True})
+
+        self.assertIn('"x509certMulti"', out.getvalue())
+
+
+class IdPCertificateRolloverTestCase(TestCase):
+    """
+    Tests accepting responses signed with any of the IdP signing certificates
+    """
+    def get_request(self):
+        with open(os.path.join(DATA_DIR, 'valid_response.xml.base64')) as response_file:
+            response = response_file.read()
+
+        return RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', data={'SAMLResponse': response})
+
+    def test_rollover(self):
+        directory = tempfile.mkdtemp()
+        settings = dict(TOKEN_AUTH_SETTINGS, idp_metadata=METADATA_PATH,
+                        idp_metadata_cache=os.path.join(directory, 'idp.json'))
+        try:
+            with self.settings(TOKEN_AUTH=settings, AUTH_USER_MODEL='tests.TestUser'):
+                # Signed with the second certificate in the metadata
+                user, created = SAMLAuthentication(self.get_request()).authenticate()
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(user.username, 'smartin')
+
+    @patch('token_auth.auth.saml.logger.error')
+    def test_other_cert(self, error):
+        new_cert = parse_idp_metadata(METADATA)['idp']['x509cert']
+        idp = dict(TOKEN_AUTH_SETTINGS['idp'], x509cert=new_cert, x509certMulti={'signing': [new_cert]})
+
+        with self.settings(TOKEN_AUTH=dict(TOKEN_AUTH_SETTINGS, idp=idp), AUTH_USER_MODEL='tests.TestUser'):
+            self.assertRaises(TokenAuthenticationError, SAMLAuthentication(self.get_request()).authenticate)
+
+        self.assertIn('Signature validation failed', error.call_args[0][0])
@@ -0,0 +1,98 @@
+from django.test import TestCase
+from mock import patch
+
+from token_auth.auth.base import BaseTokenAuthentication
+from token_auth.exceptions import TokenAuthenticationError
+from token_auth.metrics import LoggingMetrics, StatsdMetrics, get_metrics
+from token_auth.signals import stage_finished
+from token_auth.utils import get_config
+
+
+USER_DATA = {'remote_id': 'test@example.com', 'email': 'test@example.com'}
+
+
+class MeasureStageTestCase(TestCase):
+    """
+    Tests the instrumentation of the authentication stages
+    """
+    def setUp(self):
+        self.stages = []
+        stage_finished.connect(self.receiver)
+
+    def tearDown(self):
+        stage_finished.disconnect(self.receiver)
+
+    def receiver(self, sender, **kwargs):
+        self.stages.append(kwargs)
+
+    @patch.object(BaseTokenAuthentication, 'authenticate_request', return_value=dict(USER_DATA))
+    def test_stages(self, authenticate_request):
+        with self.settings(TOKEN_AUTH={}):
+            BaseTokenAuthentication(None).authenticate()
+
+        self.assertEqual(
+            [stage['stage'] for stage in self.stages],
+            ['authenticate_request', 'get_or_create_user', 'finalize', 'authenticate']
+        )
+        for stage in self.stages:
+            self.assertEqual(stage['outcome'], 'success')
+            self.assertEqual(stage['error'], None)
+            self.assertEqual(stage['queries'], None)
+            self.assertTrue(stage['duration'] >= 0)
+
+    @patch.object(BaseTokenAuthentication, 'authenticate_request',
+                  side_effect=TokenAuthenticationError('Token used', code='used'))
+    def test_error(self, authenticate_request):
+        with self.settings(TOKEN_AUTH={}):
+            self.assertRaises(TokenAuthenticationError, BaseTokenAuthentication(None).authenticate)
+
+        self.assertEqual([stage['stage'] for stage in self.stages], ['authenticate_request', 'authenticate'])
+        self.assertEqual(self.stages[0]['outcome'], 'error')
+        self.assertEqual(self.stages[0]['error'].code, 'used')
+
+    @patch.object(BaseTokenAuthentication, 'authenticate_request', return_value=dict(USER_DATA))
+    def test_queries(self, authenticate_request):
+        with self.settings(TOKEN_AUTH={'metrics_queries': True}):
+            BaseTokenAuthentication(None).authenticate()
+
+        queries = dict((stage['stage'], stage['queries']) for stage in self.stages)
+        self.assertEqual(queries['authenticate_request'], 0)
+        self.assertTrue(queries['get_or_create_user'] > 0)
+        self.assertEqual(queries['authenticate'], queries['get_or_create_user'])
+
+    @patch.object(BaseTokenAuthentication, 'authenticate_request', return_value=dict(USER_DATA))
+    @patch.object(LoggingMetrics, 'send')
+    def test_metrics(self, send, authenticate_request):
+        with self.settings(TOKEN_AUTH={'metrics': 'token_auth.metrics.LoggingMetrics'}):
+            BaseTokenAuthentication(None).authenticate()
+
+        self.assertEqual(send.call_count, 4)
+        self.assertTrue(send.call_args[0][0].startswith('token_auth.authenticate:'))
+        self.assertTrue(send.call_args[0][0].endswith('|ms|#backend:BaseTokenAuthentication,outcome:success'))
+
+
+class StatsdMetricsTestCase(TestCase):
+    """
+    Tests the statsd metrics backend
+    """
+    def test_format(self):
+        metrics = StatsdMetrics({'metrics_prefix': 'sso'})
+
+        self.assertEqual(metrics.format('login', 1.5, 'ms'), 'sso.login:1.5|ms')
+        self.assertEqual(
+            metrics.format('login', 3, 'h', {'outcome': 'error', 'backend': 'SAML'}),
+            'sso.login:3|h|#backend:SAML,outcome:error'
+        )
+
+    @patch('token_auth.metrics.socket.socket')
+    def test_send(self, socket):
+        metrics = StatsdMetrics({'metrics_host': 'statsd', 'metrics_port': 8126})
+        metrics.timing('login', 12.3456)
+
+        socket.return_value.sendto.assert_called_once_with('token_auth.login:12.346|ms', ('statsd', 8126))
+
+    def test_default(self):
+        with self.settings(TOKEN_AUTH={}):
+            metrics = get_metrics(get_config())
+
+        self.assertEqual(metrics.__class__.__name__, 'NullMetrics')
@@ -0,0 +1,51 @@
+from datetime import timedelta
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from token_auth.models import CheckedToken
+from .factories import CheckedTokenFactory, UserFactory
+
+
+class CheckedTokenPruneTestCase(TestCase):
+    """
+    Tests removing expired used tokens
+    """
+    def setUp(self):
+        user = UserFactory.create()
+        now = timezone.now()
+
+        for index in range(5):
+            CheckedTokenFactory.create(
+                token='expired-{0}'.format(index), user=user, timestamp=now - timedelta(seconds=700 + index)
+            )
+
+        for index in range(2):
+            CheckedTokenFactory.create(
+                token='valid-{0}'.format(index), user=user, timestamp=now - timedelta(seconds=index)
+            )
+
+    def test_prune(self):
+        deleted, elapsed = CheckedToken.objects.prune(600, batch_size=2)
+
+        self.assertEqual(deleted, 5)
+        self.assertEqual(
+            set(CheckedToken.objects.values_list('token', flat=True)),
+            set(['valid-0', 'valid-1'])
+        )
+
+    def test_prune_nothing_expired(self):
+        deleted, elapsed = CheckedToken.objects.prune(1000)
+
+        self.assertEqual(deleted, 0)
+        self.assertEqual(CheckedToken.objects.count(), 7)
+
+    def test_command(self):
+        out = StringIO()
+        with self.settings(TOKEN_AUTH={'token_expiration': 600}):
+            call_command('prune_checked_tokens', stdout=out, **{'batch-size': 3})
+
+        self.assertTrue(out.getvalue().startswith('Deleted 5 tokens in '))
+        self.assertEqual(CheckedToken.objects.count(), 2)
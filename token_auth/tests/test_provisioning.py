@@ -0,0 +1,149 @@
+import json
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+from mock import patch
+
+from token_auth import provisioning
+from token_auth.provisioning import provision_users
+from .factories import UserFactory
+
+
+class ProvisionUsersTestCase(TestCase):
+    """
+    Tests creating and updating users in bulk
+    """
+    def setUp(self):
+        self.user = UserFactory.create(remote_id='existing@example.com', email='existing@example.com',
+                                       first_name='Existing')
+        self.unchanged_user = UserFactory.create(remote_id='unchanged@example.com', email='unchanged@example.com',
+                                                 username='unchanged', first_name='Renko', last_name='ter Kuile')
+        self.caps_user = UserFactory.create(remote_id='CAPS@example.com', email='caps@example.com',
+                                            username='caps', first_name='Caps')
+        self.records = [
+            {'remote_id': 'new@example.com', 'email': 'new@example.com', 'first_name': 'New', 'timestamp': 'x'},
+            {'remote_id': 'existing@example.com', 'email': 'existing@example.com', 'first_name': 'Updated'},
+            {'remote_id': 'unchanged@example.com', 'email': 'unchanged@example.com', 'first_name': 'Renko'},
+            {'remote_id': 'caps@example.com', 'email': 'caps@example.com', 'first_name': 'Caps'},
+        ]
+
+    def test_provision(self):
+        with self.settings(TOKEN_AUTH={}):
+            totals = provision_users(self.records, batch_size=3)
+
+        self.assertEqual(totals, {'created': 1, 'updated': 2, 'unchanged': 1})
+
+        user_model = get_user_model()
+        self.assertEqual(user_model.objects.get(remote_id='new@example.com').first_name, 'New')
+        self.assertEqual(user_model.objects.get(pk=self.user.pk).first_name, 'Updated')
+        self.assertEqual(user_model.objects.get(pk=self.caps_user.pk).remote_id, 'caps@example.com')
+        self.assertEqual(user_model.objects.count(), 4)
+
+    def test_provision_queries(self):
+        records = [
+            {'remote_id': 'user-{0}@example.com'.format(index), 'email': 'user-{0}@example.com'.format(index)}
+            for index in range(100)
+        ]
+        with self.settings(TOKEN_AUTH={}):
+            # Exact match, case insensitive match and one insert (in a savepoint)
+            with self.assertNumQueries(5):
+                provision_users(records)
+
+        self.assertEqual(get_user_model().objects.count(), 103)
+
+    def test_update_queries(self):
+        user_model = get_user_model()
+        records = []
+        for index in range(150):
+            email = 'user-{0}@example.com'.format(index)
+            UserFactory.create(remote_id=email, email=email, first_name='Old')
+            records.append({'remote_id': email, 'email': email, 'first_name': 'New {0}'.format(index)})
+
+        with self.settings(TOKEN_AUTH={}):
+            # Exact match and two updates of at most 100 users
+            with self.assertNumQueries(5):
+                totals = provision_users(records)
+
+        self.assertEqual(totals, {'created': 0, 'updated': 150, 'unchanged': 0})
+        self.assertEqual(
+            sorted(user_model.objects.filter(first_name__startswith='New').values_list('first_name', flat=True)),
+            sorted(record['first_name'] for record in records)
+        )
+
+    def test_created_concurrently(self):
+        records = [{'remote_id': 'login@example.com', 'email': 'login@example.com', 'first_name': 'Provisioned'}]
+        UserFactory.create(remote_id='login@example.com', email='login@example.com', first_name='Login')
+
+        get_existing_users = provisioning._get_existing_users
+        lookups = []
+
+        def get_existing_later(*args):
+            # The first lookup does not see the user a concurrent login creates
+            lookups.append(args)
+            return get_existing_users(*args) if len(lookups) > 1 else {}
+
+        with self.settings(TOKEN_AUTH={}):
+            with patch.object(provisioning, '_get_existing_users', side_effect=get_existing_later):
+                totals = provision_users(records)
+
+        self.assertEqual(totals, {'created': 0, 'updated': 1, 'unchanged': 0})
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(get_user_model().objects.get(email='login@example.com').first_name, 'Provisioned')
+
+    def test_case_insensitive(self):
+        records = [
+            {'remote_id': 'Mixed@example.com', 'email': 'mixed@example.com', 'first_name': 'First'},
+            {'remote_id': 'mixed@example.com', 'email': 'mixed@example.com', 'first_name': 'Second'},
+            {'remote_id': 'Existing@Example.com', 'email': 'existing@example.com', 'first_name': 'Existing'},
+        ]
+        with self.settings(TOKEN_AUTH={}):
+            totals = provision_users(records)
+
+        self.assertEqual(totals, {'created': 1, 'updated': 1, 'unchanged': 0})
+        user_model = get_user_model()
+        self.assertEqual(user_model.objects.get(email='mixed@example.com').first_name, 'Second')
+        self.assertEqual(user_model.objects.get(pk=self.user.pk).remote_id, 'Existing@Example.com')
+
+    def test_progress(self):
+        progress = []
+        with self.settings(TOKEN_AUTH={}):
+            provision_users(self.records, batch_size=2, progress=lambda totals: progress.append(dict(totals)))
+
+        self.assertEqual(len(progress), 2)
+        self.assertEqual(sum(progress[0].values()), 2)
+
+    def test_command(self):
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(handle, 'w') as output:
+            for record in self.records:
+                output.write(json.dumps(record) + '\n')
+
+        out = StringIO()
+        try:
+            with self.settings(TOKEN_AUTH={}):
+                call_command('provision_users', path, stdout=out)
+        finally:
+            os.remove(path)
+
+        self.assertIn('Created 1, updated 2, unchanged 1 users', out.getvalue())
+
+    def test_command_csv(self):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as output:
+            # The short row leaves the first name alone
+            output.write('remote_id,email,first_name\nnew@example.com,new@example.com,New\n'
+                         'existing@example.com,existing@example.com\n')
+
+        try:
+            with self.settings(TOKEN_AUTH={}):
+                call_command('provision_users', path, stdout=StringIO())
+        finally:
+            os.remove(path)
+
+        user_model = get_user_model()
+        self.assertEqual(user_model.objects.get(remote_id='new@example.com').first_name, 'New')
+        self.assertEqual(user_model.objects.get(pk=self.user.pk).first_name, 'Existing')
@@ -1,16 +1,27 @@
+import base64
+import pickle
 import urlparse
 import os
-from mock import patch
+import time
+from multiprocessing import TimeoutError
+from mock import Mock, patch
 
 from django.test import TestCase, RequestFactory
 
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
 from onelogin.saml2.utils import OneLogin_Saml2_Utils
 import xml.etree.ElementTree as ET
 
 from token_auth.exceptions import TokenAuthenticationError
-from token_auth.auth.saml import SAMLAuthentication
+from token_auth.auth.saml import (
+    SIGNATURE_NAMESPACE, SPACE, SAMLAuthentication, ValidationPool, check_saml_response, decode_chunks,
+    get_picklable_request, get_saml_request, get_validation_pool, start_validation_pool
+)
 from token_auth.tests.factories import UserFactory
 from token_auth.tests.saml_settings import TOKEN_AUTH2_SETTINGS
+from token_auth.stores import get_assertion_store
+from token_auth.utils import get_config
 
 from .saml_settings import TOKEN_AUTH_SETTINGS
 
@@ -245,3 +256,309 @@ class TestSAMLTokenAuthentication(TestCase):
             self.assertEqual(rac[0].attrib['Comparison'], "minimal")
             # RequestedAuthnContext should have 6 options / children
             self.assertEqual(len(rac[0]), 6)
+
+    @patch('token_auth.auth.saml.logger.error')
+    def test_replayed(self, error):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS, AUTH_USER_MODEL='tests.TestUser'):
+            filename = os.path.join(os.path.dirname(__file__), 'data/valid_response.xml.base64')
+            with open(filename) as response_file:
+                response = response_file.read()
+
+            SAMLAuthentication.rejections.reset()
+            SAMLAuthentication(
+                RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', data={'SAMLResponse': response})
+            ).authenticate()
+
+            auth_backend = SAMLAuthentication(
+                RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', data={'SAMLResponse': response})
+            )
+            with patch('token_auth.auth.saml.SAMLAuth.process_response') as process_response:
+                with self.assertRaises(TokenAuthenticationError) as context:
+                    auth_backend.authenticate()
+
+            self.assertEqual(context.exception.code, 'replayed')
+            self.assertFalse(process_response.called)
+            self.assertEqual(SAMLAuthentication.rejections.as_dict(), {'replayed': 1})
+
+    @patch('token_auth.auth.saml.logger.error')
+    def test_replayed_assertion(self, error):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS, AUTH_USER_MODEL='tests.TestUser'):
+            filename = os.path.join(os.path.dirname(__file__), 'data/valid_response.xml.base64')
+            with open(filename) as response_file:
+                response = response_file.read()
+
+            auth_backend = SAMLAuthentication(
+                RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', data={'SAMLResponse': response})
+            )
+            # Only the assertion was used before, in another response
+            get_assertion_store(get_config()).mark_used('pfxb4ec9c8a-48eb-fda2-7f74-fa1a105a99fe')
+
+            with self.assertRaises(TokenAuthenticationError) as context:
+                auth_backend.authenticate()
+
+            self.assertEqual(context.exception.code, 'replayed')
+            self.assertEqual(
+                auth_backend.auth.replay_ids,
+                ['pfx05f3ce10-1615-f3ea-a988-60e380b3299f', 'pfxb4ec9c8a-48eb-fda2-7f74-fa1a105a99fe']
+            )
+            # NotOnOrAfter (2023-08-23T06:57:01Z), plus the allowed clock drift
+            self.assertEqual(auth_backend.auth.expires, 1692773821 + OneLogin_Saml2_Constants.ALLOWED_CLOCK_DRIFT)
+
+    def test_saml_settings_parsed_once(self):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS, AUTH_USER_MODEL='tests.TestUser'):
+            with patch('token_auth.auth.saml.OneLogin_Saml2_Settings', wraps=OneLogin_Saml2_Settings) as settings:
+                first = SAMLAuthentication(RequestFactory().get('/sso/redirect', HTTP_HOST='www.stuff.com'))
+                second = SAMLAuthentication(RequestFactory().get('/sso/redirect', HTTP_HOST='www.stuff.com'))
+
+                self.assertEqual(settings.call_count, 1)
+                self.assertIs(first.auth.get_settings(), second.auth.get_settings())
+
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH2_SETTINGS, AUTH_USER_MODEL='tests.TestUser'):
+            third = SAMLAuthentication(RequestFactory().get('/sso/redirect', HTTP_HOST='www.stuff.com'))
+            self.assertIsNot(first.auth.get_settings(), third.auth.get_settings())
+
+
+POOL_SETTINGS = dict(TOKEN_AUTH_SETTINGS, saml_validation_processes=1)
+
+
+def kill_worker(*args):
+    os._exit(1)
+
+
+class TestSAMLValidationPool(TestCase):
+    """
+    Tests validating SAML responses in a process pool.
+    """
+    def get_request(self, name):
+        filename = os.path.join(os.path.dirname(__file__), 'data', name)
+        with open(filename) as response_file:
+            response = response_file.read()
+
+        return RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', data={'SAMLResponse': response})
+
+    def test_auth_success(self):
+        with self.settings(TOKEN_AUTH=POOL_SETTINGS, AUTH_USER_MODEL='tests.TestUser'):
+            try:
+                user, created = SAMLAuthentication(self.get_request('valid_response.xml.base64')).authenticate()
+            finally:
+                get_validation_pool(get_config()).close()
+
+            self.assertTrue(created)
+            self.assertEqual(user.email, 'smartin@yaco.es')
+            self.assertEqual(user.remote_id, '492882615acf31c8096b627245d76ae53036c090')
+            self.assertTrue(get_assertion_store(get_config()).is_used('pfxb4ec9c8a-48eb-fda2-7f74-fa1a105a99fe'))
+
+    @patch('token_auth.auth.saml.logger.error')
+    def test_auth_invalid(self, error):
+        with self.settings(TOKEN_AUTH=POOL_SETTINGS, AUTH_USER_MODEL='tests.TestUser'):
+            auth_backend = SAMLAuthentication(self.get_request('invalid_response.xml.base64'))
+
+            try:
+                self.assertRaises(TokenAuthenticationError, auth_backend.authenticate)
+            finally:
+                get_validation_pool(get_config()).close()
+            error.assert_called_with((
+                'Saml login error: [\'invalid_response\'], reason: '
+                'Signature validation failed. SAML Response rejected'
+            ))
+
+    def test_saturated(self):
+        with self.settings(TOKEN_AUTH=dict(POOL_SETTINGS, saml_validation_queue=1), AUTH_USER_MODEL='tests.TestUser'):
+            auth_backend = SAMLAuthentication(self.get_request('valid_response.xml.base64'))
+            get_validation_pool(get_config()).slots.acquire()
+
+            with self.assertRaises(TokenAuthenticationError) as context:
+                auth_backend.authenticate()
+
+            self.assertEqual(context.exception.code, 'saturated')
+
+    def test_timeout(self):
+        with self.settings(TOKEN_AUTH=dict(POOL_SETTINGS, saml_validation_queue=1), AUTH_USER_MODEL='tests.TestUser'):
+            auth_backend = SAMLAuthentication(self.get_request('valid_response.xml.base64'))
+            pool = get_validation_pool(get_config())
+
+            with patch.object(ValidationPool, 'get_pool') as get_pool:
+                process_pool = get_pool.return_value
+                process_pool.apply_async.return_value.get.side_effect = TimeoutError
+                process_pool.apply_async.return_value.ready.return_value = False
+                with self.assertRaises(TokenAuthenticationError) as context:
+                    auth_backend.authenticate()
+
+            self.assertEqual(context.exception.code, 'timeout')
+            self.assertEqual(process_pool.apply_async.return_value.get.call_args[0], (10, ))
+            # The slot is only released when the validation finishes
+            self.assertFalse(pool.slots.acquire(False))
+
+    @patch('token_auth.auth.saml.logger')
+    def test_submit_failed(self, logger):
+        with self.settings(TOKEN_AUTH=dict(POOL_SETTINGS, saml_validation_queue=1), AUTH_USER_MODEL='tests.TestUser'):
+            auth_backend = SAMLAuthentication(self.get_request('valid_response.xml.base64'))
+            pool = get_validation_pool(get_config())
+
+            with patch.object(ValidationPool, 'get_pool') as get_pool:
+                # Like a pool that was terminated
+                get_pool.return_value.apply_async.side_effect = AssertionError
+                with self.assertRaises(TokenAuthenticationError) as context:
+                    auth_backend.authenticate()
+
+            self.assertEqual(context.exception.code, 'error')
+            self.assertTrue(pool.slots.acquire(False))
+
+    @patch('token_auth.auth.saml.Pool')
+    def test_start(self, process_pool):
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS):
+            start_validation_pool()
+            self.assertFalse(process_pool.called)
+
+        with self.settings(TOKEN_AUTH=POOL_SETTINGS):
+            start_validation_pool()
+            process_pool.assert_called_once_with(1)
+
+            pool = get_validation_pool(get_config())
+            with pool._lock:
+                self.assertIs(pool.get_pool(), process_pool.return_value)
+
+                # A new pool in a forked process
+                pool._pid = -1
+                pool.get_pool()
+            self.assertEqual(process_pool.call_count, 2)
+
+    @patch('token_auth.auth.saml.logger.error')
+    def test_worker_died(self, error):
+        settings = dict(POOL_SETTINGS, saml_validation_queue=1, saml_validation_timeout=0.2)
+        with self.settings(TOKEN_AUTH=settings, AUTH_USER_MODEL='tests.TestUser'):
+            pool = get_validation_pool(get_config())
+            try:
+                with patch('token_auth.auth.saml.process_response', kill_worker):
+                    with self.assertRaises(TokenAuthenticationError) as context:
+                        SAMLAuthentication(self.get_request('valid_response.xml.base64')).authenticate()
+                    self.assertEqual(context.exception.code, 'timeout')
+
+                    with self.assertRaises(TokenAuthenticationError) as context:
+                        SAMLAuthentication(self.get_request('valid_response.xml.base64')).authenticate()
+                    self.assertEqual(context.exception.code, 'saturated')
+
+                # Twice the timeout later, the slot is given back and the pool replaced
+                time.sleep(0.4)
+                user, created = SAMLAuthentication(self.get_request('valid_response.xml.base64')).authenticate()
+            finally:
+                pool.close()
+
+            self.assertEqual(user.email, 'smartin@yaco.es')
+            self.assertEqual(pool.pending, {})
+            self.assertTrue(pool.slots.acquire(False))
+
+    def test_picklable_request(self):
+        with self.settings(TOKEN_AUTH=POOL_SETTINGS, AUTH_USER_MODEL='tests.TestUser'):
+            auth_backend = SAMLAuthentication(self.get_request('valid_response.xml.base64'))
+
+        request_data = get_picklable_request(auth_backend.request_data)
+        self.assertEqual(pickle.loads(pickle.dumps(request_data)), request_data)
+        self.assertIs(type(request_data['post_data']), dict)
+
+
+class TestSAMLRequest(TestCase):
+    """
+    Tests the request data passed to python-saml.
+    """
+    def test_not_copied(self):
+        request = RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', data={'SAMLResponse': 'response'})
+        saml_request = get_saml_request(request)
+
+        self.assertIs(saml_request['post_data'], request.POST)
+        self.assertIs(saml_request['get_data'], request.POST)
+        self.assertEqual(saml_request['post_data']['SAMLResponse'], 'response')
+        self.assertEqual(saml_request['server_port'], '80')
+        self.assertEqual(saml_request['https'], 'off')
+
+    def test_forwarded(self):
+        request = RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', HTTP_X_FORWARDED_FOR='10.0.0.2',
+                                        HTTP_X_FORWARDED_PROTO='https')
+        saml_request = get_saml_request(request)
+
+        self.assertEqual(saml_request['https'], 'on')
+        self.assertNotIn('server_port', saml_request)
+
+    def test_trusted_proxy(self):
+        request = RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', REMOTE_ADDR='10.0.0.1',
+                                        HTTP_X_FORWARDED_PROTO='https', HTTP_X_FORWARDED_PORT='8443')
+        saml_request = get_saml_request(request, trusted_proxies=['10.0.0.1'])
+
+        self.assertEqual(saml_request['https'], 'on')
+        self.assertEqual(saml_request['server_port'], '8443')
+
+    def test_untrusted_proxy(self):
+        request = RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com', REMOTE_ADDR='10.0.0.3',
+                                        HTTP_X_FORWARDED_FOR='10.0.0.2', HTTP_X_FORWARDED_PROTO='https',
+                                        HTTP_X_FORWARDED_PORT='8443')
+        saml_request = get_saml_request(request, trusted_proxies=['10.0.0.1'])
+
+        self.assertEqual(saml_request['https'], 'off')
+        self.assertEqual(saml_request['server_port'], '80')
+
+
+class TestCheckSAMLResponse(TestCase):
+    """
+    Tests the checks of SAML responses before they are parsed.
+    """
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), 'data', 'valid_response.xml.base64')) as response_file:
+            self.response = response_file.read()
+
+    def assertRejected(self, code, encoded, **kwargs):
+        with self.assertRaises(TokenAuthenticationError) as context:
+            check_saml_response(encoded, **kwargs)
+        self.assertEqual(context.exception.code, code)
+
+    def test_valid(self):
+        self.assertEqual(check_saml_response(self.response), 'pfx05f3ce10-1615-f3ea-a988-60e380b3299f')
+        self.assertEqual(check_saml_response(unicode(self.response)), 'pfx05f3ce10-1615-f3ea-a988-60e380b3299f')
+
+    def test_decode_chunks(self):
+        encoded = base64.encodestring('x' * 1000)
+
+        self.assertEqual(''.join(decode_chunks(encoded, chunk_size=100)), 'x' * 1000)
+
+    def test_too_large(self):
+        self.assertRejected('too_large', self.response, max_size=1000)
+        self.assertRejected('too_large', self.response, max_decoded_size=1000)
+
+    def test_malformed(self):
+        self.assertRejected('malformed', self.response + '?')
+        self.assertRejected('malformed', self.response[:-3])
+        self.assertRejected('malformed', u'\u20ac' + self.response)
+
+    def test_wrong_root(self):
+        self.assertRejected('wrong_root', base64.b64encode('<!DOCTYPE x><samlp:Response />'))
+        self.assertRejected('wrong_root', base64.b64encode('<samlp:LogoutResponse />'))
+        self.assertRejected('wrong_root', base64.b64encode('<!-- unterminated <samlp:Response />'))
+
+    def test_comments(self):
+        comments = '<?xml version="1.0"?>\n<!-- a --> <!---->\n'
+        self.assertEqual(
+            check_saml_response(base64.b64encode(comments + '<samlp:Response ID="x">' + SIGNATURE_NAMESPACE)), 'x'
+        )
+
+    def test_many_comments(self):
+        # Used to backtrack exponentially in the number of comments, now every comment is scanned once
+        for count in (50, 500):
+            with patch('token_auth.auth.saml.SPACE', Mock(wraps=SPACE)) as space:
+                self.assertRejected('wrong_root', base64.b64encode('<!---->' * count + '<samlp:LogoutResponse />'))
+            self.assertEqual(space.match.call_count, count + 1)
+
+    def test_unsigned(self):
+        self.assertRejected('unsigned', base64.b64encode('<?xml version="1.0"?><samlp:Response></samlp:Response>'))
+
+    @patch('token_auth.auth.saml.logger.error')
+    def test_authenticate_rejected(self, error):
+        request = RequestFactory().post('/sso/auth', HTTP_HOST='www.stuff.com',
+                                        data={'SAMLResponse': base64.b64encode('<html />')})
+        SAMLAuthentication.rejections.reset()
+
+        with self.settings(TOKEN_AUTH=TOKEN_AUTH_SETTINGS, AUTH_USER_MODEL='tests.TestUser'):
+            with patch('token_auth.auth.saml.SAMLAuth.process_response') as process_response:
+                self.assertRaises(TokenAuthenticationError, SAMLAuthentication(request).authenticate)
+
+        self.assertFalse(process_response.called)
+        self.assertEqual(SAMLAuthentication.rejections.as_dict(), {'wrong_root': 1})
+        error.assert_called_with('Saml login error: SAML response is not a Response')
@@ -0,0 +1,100 @@
+from datetime import datetime
+
+from django.core.cache import caches
+from mock import patch
+from django.test import TestCase
+from django.utils import timezone
+
+from token_auth.models import CheckedToken
+from token_auth.stores import AssertionStore, CacheTokenStore, ModelTokenStore, get_assertion_store
+from token_auth.utils import get_config
+from .factories import UserFactory
+
+
+STORE_SETTINGS = {
+    'token_expiration': 600,
+}
+
+
+class TokenStoreTestMixin(object):
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.timestamp = timezone.make_aware(datetime(2013, 12, 23, 17, 51, 15))
+
+    def test_mark_used(self):
+        self.assertFalse(self.store.is_used('some-token'))
+        self.assertTrue(self.store.mark_used('some-token', self.user, self.timestamp))
+        self.assertTrue(self.store.is_used('some-token'))
+        self.assertFalse(self.store.is_used('other-token'))
+
+    def test_mark_used_twice(self):
+        self.assertTrue(self.store.mark_used('some-token', self.user, self.timestamp))
+        self.assertFalse(self.store.mark_used('some-token', self.user, self.timestamp))
+
+
+class ModelTokenStoreTestCase(TokenStoreTestMixin, TestCase):
+    def setUp(self):
+        super(ModelTokenStoreTestCase, self).setUp()
+        self.store = ModelTokenStore(STORE_SETTINGS)
+
+    def test_stored_in_db(self):
+        self.store.mark_used('some-token', self.user, self.timestamp)
+
+        checked_token = CheckedToken.objects.get()
+        self.assertEqual(checked_token.token, 'some-token')
+        self.assertEqual(checked_token.user, self.user)
+
+
+class CacheTokenStoreTestCase(TokenStoreTestMixin, TestCase):
+    def setUp(self):
+        super(CacheTokenStoreTestCase, self).setUp()
+        caches['default'].clear()
+        self.store = CacheTokenStore(STORE_SETTINGS)
+
+    def test_no_queries(self):
+        with self.assertNumQueries(0):
+            self.store.mark_used('some-token', self.user, self.timestamp)
+            self.store.is_used('some-token')
+
+    def test_configured(self):
+        with self.settings(TOKEN_AUTH=dict(STORE_SETTINGS, token_store='token_auth.stores.CacheTokenStore')):
+            self.assertTrue(isinstance(get_config().token_store, CacheTokenStore))
+            self.assertIs(get_config().token_store, get_config().token_store)
+
+    def test_default(self):
+        with self.settings(TOKEN_AUTH=STORE_SETTINGS):
+            self.assertTrue(isinstance(get_config().token_store, ModelTokenStore))
+
+
+class AssertionStoreTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.store = AssertionStore({})
+
+    def test_mark_used(self):
+        self.assertFalse(self.store.is_used('response-id'))
+        self.assertTrue(self.store.mark_used('response-id'))
+        self.assertTrue(self.store.is_used('response-id'))
+        self.assertFalse(self.store.mark_used('response-id'))
+        self.assertFalse(self.store.is_used('other-id'))
+
+    def test_shared_cache(self):
+        settings = {'saml_replay_cache': 'default'}
+        self.assertTrue(AssertionStore(settings).mark_used('response-id'))
+
+        # Another process only shares the Django cache
+        other = AssertionStore(settings)
+        self.assertTrue(other.is_used('response-id'))
+        self.assertFalse(other.mark_used('response-id'))
+
+    @patch('token_auth.stores.time.time', return_value=1000)
+    def test_timeout(self, time):
+        self.assertEqual(self.store.get_timeout(1100.5), 101)
+        self.assertEqual(self.store.get_timeout(None), 3600)
+        # Accepted while expired, when not strict
+        self.assertEqual(self.store.get_timeout(900), 3600)
+
+    def test_configured(self):
+        with self.settings(TOKEN_AUTH={'saml_replay_timeout': 60}):
+            self.assertIs(get_assertion_store(get_config()), get_assertion_store(get_config()))
+            self.assertEqual(get_assertion_store(get_config()).default_timeout, 60)
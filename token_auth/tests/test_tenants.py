@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.test import RequestFactory, TestCase
+from mock import patch
+
+from token_auth.exceptions import TokenAuthenticationError, UnknownTenant
+from token_auth.models import Tenant
+from token_auth.tenants import (
+    LOCK_STRIPES, DirectoryTenantLoader, ModelTenantLoader, SettingsTenantLoader, TenantRegistry, get_request_config,
+    get_tenant_registry
+)
+from token_auth.utils import TokenAuthConfig, get_config
+from token_auth.views import MetadataView, TokenLoginView, get_auth
+
+
+TENANT_AUTH = {
+    'backend': 'token_auth.tests.test_views.DummyAuthentication',
+    'tenant_loader': 'token_auth.tenants.SettingsTenantLoader',
+    'tenants': {
+        'first': {'sso_url': 'https://first.example.com'},
+        'second': {'sso_url': 'https://second.example.com', 'metadata_max_age': 60},
+    }
+}
+
+
+class TenantRegistryTestCase(TestCase):
+    """
+    Tests loading and caching the configurations of tenants
+    """
+    def setUp(self):
+        self.root = TokenAuthConfig(TENANT_AUTH)
+        self.registry = TenantRegistry(self.root, SettingsTenantLoader(TENANT_AUTH), size=2)
+
+    def test_get_config(self):
+        config = self.registry.get_config('first')
+
+        self.assertEqual(config.settings['sso_url'], 'https://first.example.com')
+        self.assertEqual(config.settings['backend'], TENANT_AUTH['backend'])
+        self.assertIs(config.root, self.root)
+        self.assertIs(self.registry.get_config('first'), config)
+        self.assertIsNot(self.registry.get_config('second'), config)
+
+    def test_unknown(self):
+        self.assertRaises(UnknownTenant, self.registry.get_config, 'third')
+        self.assertRaises(UnknownTenant, self.registry.get_config, '../first')
+
+    def test_unknown_cached(self):
+        with patch.object(SettingsTenantLoader, 'load', return_value=None) as load:
+            for _index in range(3):
+                self.assertRaises(UnknownTenant, self.registry.get_config, 'third')
+            self.assertEqual(load.call_count, 1)
+
+            self.registry.unknown.clear()
+            self.assertRaises(UnknownTenant, self.registry.get_config, 'third')
+            self.assertEqual(load.call_count, 2)
+
+    @patch('token_auth.tenants.time.time', return_value=1000)
+    def test_reloading(self, time):
+        config = self.registry.get_config('first')
+        time.return_value = 1000 + 301
+
+        lock = self.registry._locks[hash('first') % LOCK_STRIPES]
+        with lock, patch.object(SettingsTenantLoader, 'load') as load:
+            # Another thread is reloading it
+            self.assertIs(self.registry.get_config('first'), config)
+            self.assertFalse(load.called)
+
+    def test_evicted(self):
+        with patch.object(SettingsTenantLoader, 'load', wraps=self.registry.loader.load) as load:
+            self.registry.get_config('first')
+            self.registry.get_config('second')
+            self.registry.get_config('first')
+            self.assertEqual(load.call_count, 2)
+
+            self.registry.configs.set('other', None)
+            self.registry.get_config('second')
+            self.assertEqual(load.call_count, 3)
+
+    @patch('token_auth.tenants.time.time', return_value=1000)
+    def test_reload(self, time):
+        config = self.registry.get_config('first')
+
+        time.return_value = 1000 + 301
+        self.assertIs(self.registry.get_config('first'), config)
+
+        self.registry.loader.tenants = {'first': {'sso_url': 'https://new.example.com'}}
+        time.return_value = 1000 + 602
+        self.assertEqual(self.registry.get_config('first').settings['sso_url'], 'https://new.example.com')
+
+        self.registry.loader.tenants = {}
+        time.return_value = 1000 + 903
+        self.assertRaises(UnknownTenant, self.registry.get_config, 'first')
+
+
+class TenantLoaderTestCase(TestCase):
+    """
+    Tests loading the settings of tenants
+    """
+    def test_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'first.json'), 'w') as tenant_file:
+                json.dump({'sso_url': 'https://first.example.com'}, tenant_file)
+
+            loader = DirectoryTenantLoader({'tenant_directory': directory})
+            self.assertEqual(loader.load('first'), {'sso_url': 'https://first.example.com'})
+            self.assertEqual(loader.load('second'), None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_model(self):
+        Tenant.objects.create(name='first', settings='{"sso_url": "https://first.example.com"}')
+        Tenant.objects.create(name='second', settings='{}', is_active=False)
+        loader = ModelTenantLoader({})
+
+        self.assertEqual(loader.load('first'), {'sso_url': 'https://first.example.com'})
+        self.assertEqual(loader.load('second'), None)
+        self.assertEqual(loader.load('third'), None)
+
+    def test_model_clean(self):
+        Tenant(name='first', settings='{}').clean()
+        self.assertRaises(ValidationError, Tenant(name='first', settings='{').clean)
+        self.assertRaises(ValidationError, Tenant(name='first', settings='[]').clean)
+
+
+class TenantViewsTestCase(TestCase):
+    """
+    Tests selecting the tenant of a request
+    """
+    def test_without_tenants(self):
+        with self.settings(TOKEN_AUTH={'backend': TENANT_AUTH['backend']}):
+            self.assertEqual(get_tenant_registry(get_config()), None)
+            self.assertIs(get_request_config(RequestFactory().get('/'), 'first'), get_config())
+
+    def test_url(self):
+        with self.settings(TOKEN_AUTH=TENANT_AUTH):
+            auth = get_auth(RequestFactory().get('/'), tenant='second', token='token')
+
+            self.assertEqual(auth.settings['sso_url'], 'https://second.example.com')
+            self.assertEqual(auth.args, {'token': 'token'})
+            self.assertIs(get_auth(RequestFactory().get('/')).config, get_config())
+
+    def test_host(self):
+        with self.settings(TOKEN_AUTH=dict(TENANT_AUTH, tenant_from='host'), ALLOWED_HOSTS=['*']):
+            auth = get_auth(RequestFactory().get('/', HTTP_HOST='first:8000'))
+
+        self.assertEqual(auth.settings['sso_url'], 'https://first.example.com')
+
+    def test_unknown(self):
+        with self.settings(TOKEN_AUTH=TENANT_AUTH):
+            self.assertRaises(Http404, MetadataView().get, RequestFactory().get('/'), tenant='third')
+
+    @patch('token_auth.tests.test_views.DummyAuthentication.authenticate',
+           side_effect=TokenAuthenticationError('invalid', code='malformed'))
+    def test_error_redirect(self, authenticate):
+        with self.settings(TOKEN_AUTH=TENANT_AUTH, ROOT_URLCONF='token_auth.tests.urls'):
+            response = TokenLoginView().get(RequestFactory().get('/second/token/login/bad'), token='bad',
+                                            tenant='second')
+            # Rejected again from the cache
+            cached = TokenLoginView().get(RequestFactory().get('/second/token/login/bad'), token='bad',
+                                          tenant='second')
+
+        self.assertEqual(response['Location'], "/second/token/error/?message='invalid'")
+        self.assertEqual(cached['Location'], response['Location'])
+
+    def test_metadata(self):
+        with self.settings(TOKEN_AUTH=TENANT_AUTH):
+            response = MetadataView().get(RequestFactory().get('/'), tenant='second')
+
+        self.assertIn('max-age=60', response['Cache-Control'])
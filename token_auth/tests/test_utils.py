@@ -0,0 +1,69 @@
+import threading
+import time
+
+from mock import patch
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from token_auth import utils
+from token_auth.auth.booking import TokenAuthentication
+from token_auth.utils import get_config, get_settings, reset_config
+
+
+BOOKING_AUTH = {'backend': 'token_auth.auth.booking.TokenAuthentication'}
+
+
+class ConfigTestCase(TestCase):
+    """
+    Tests the process wide TOKEN_AUTH configuration
+    """
+    def tearDown(self):
+        reset_config()
+
+    @override_settings(TOKEN_AUTH=BOOKING_AUTH)
+    def test_resolved_once(self):
+        with patch.object(utils, 'import_string', wraps=utils.import_string) as import_string:
+            reset_config()
+            self.assertEqual(get_settings(), BOOKING_AUTH)
+            self.assertIs(get_config(), get_config())
+            self.assertEqual(get_config().backend_class, TokenAuthentication)
+            self.assertEqual(get_config().backend_class, TokenAuthentication)
+
+            # Once for the settings, once for the backend
+            self.assertEqual(import_string.call_count, 2)
+
+    @override_settings(TOKEN_AUTH=BOOKING_AUTH)
+    def test_reset_on_setting_changed(self):
+        config = get_config()
+
+        with self.settings(TOKEN_AUTH={'backend': 'token_auth.auth.saml.SAMLAuthentication'}):
+            self.assertIsNot(get_config(), config)
+            self.assertEqual(get_settings()['backend'], 'token_auth.auth.saml.SAMLAuthentication')
+
+        self.assertEqual(get_settings(), BOOKING_AUTH)
+
+    @override_settings(TOKEN_AUTH=BOOKING_AUTH)
+    def test_concurrent_first_use(self):
+        reset_config()
+        load_settings = utils.load_settings
+
+        def slow_load_settings():
+            time.sleep(0.01)
+            return load_settings()
+
+        configs = []
+        with patch.object(utils, 'load_settings', side_effect=slow_load_settings):
+            threads = [threading.Thread(target=lambda: configs.append(get_config())) for index in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(set(id(config) for config in configs)), 1)
+
+    @override_settings(TOKEN_AUTH={})
+    def test_backend_not_set(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_config().backend_class
@@ -7,7 +7,7 @@ from django.test.testcases import TestCase
 
 from token_auth.auth import booking, base
 from token_auth.exceptions import TokenAuthenticationError
-from token_auth.views import get_auth, TokenRedirectView, TokenLoginView
+from token_auth.views import get_auth, TokenRedirectView, TokenLoginView, MetadataView
 
 
 DUMMY_AUTH = {'backend': 'token_auth.tests.test_views.DummyAuthentication'}
@@ -21,6 +21,9 @@ class DummyUser(object):
 
 
 class DummyAuthentication(base.BaseTokenAuthentication):
+    def get_metadata(self):
+        return '<metadata />'
+
     def authenticate(self):
         if getattr(self.request, 'fails', False):
             raise TokenAuthenticationError('test message')
@@ -112,3 +115,69 @@ class LoginViewTestCase(TestCase):
             response['Location'],
             "/token/error?message='test%20message'"
         )
+
+    @patch('token_auth.tests.test_views.DummyAuthentication.authenticate',
+           side_effect=TokenAuthenticationError('used', code='used'))
+    def test_get_rejected_token_cached(self, authenticate):
+        first = self.view.get(self.factory.get('/api/sso/authenticate'), token='used-token')
+        second = self.view.get(self.factory.get('/api/sso/authenticate'), token='used-token')
+
+        self.assertEqual(authenticate.call_count, 1)
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(second['Location'], "/token/error?message='used'")
+
+    @patch('token_auth.tests.test_views.DummyAuthentication.authenticate',
+           side_effect=TokenAuthenticationError('busy', code='saturated'))
+    def test_get_temporary_rejection_not_cached(self, authenticate):
+        self.view.get(self.factory.get('/api/sso/authenticate'), token='token')
+        self.view.get(self.factory.get('/api/sso/authenticate'), token='token')
+
+        self.assertEqual(authenticate.call_count, 2)
+
+    @patch('token_auth.tests.test_views.DummyAuthentication.authenticate',
+           side_effect=TokenAuthenticationError('used', code='used'))
+    def test_get_rejected_token_cache_disabled(self, authenticate):
+        with self.settings(TOKEN_AUTH=dict(DUMMY_AUTH, rejected_token_cache_size=0)):
+            self.view.get(self.factory.get('/api/sso/authenticate'), token='used-token')
+            self.view.get(self.factory.get('/api/sso/authenticate'), token='used-token')
+
+        self.assertEqual(authenticate.call_count, 2)
+
+
+@override_settings(TOKEN_AUTH=DUMMY_AUTH)
+class MetadataViewTestCase(TestCase):
+    def setUp(self):
+        self.view = MetadataView()
+        self.factory = RequestFactory()
+
+    def test_get(self):
+        response = self.view.get(self.factory.get('/api/sso/metadata'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '<metadata />')
+        self.assertEqual(response['Content-Type'], 'text/xml')
+        self.assertTrue(response['ETag'])
+        self.assertTrue(response['Last-Modified'])
+        self.assertIn('max-age=3600', response['Cache-Control'])
+
+    @patch('token_auth.tests.test_views.DummyAuthentication.get_metadata',
+           return_value='<metadata />')
+    def test_generated_once(self, get_metadata):
+        self.view.get(self.factory.get('/api/sso/metadata'))
+        self.view.get(self.factory.get('/api/sso/metadata'))
+
+        self.assertEqual(get_metadata.call_count, 1)
+
+    def test_not_modified(self):
+        etag = self.view.get(self.factory.get('/api/sso/metadata'))['ETag']
+
+        response = self.view.get(self.factory.get('/api/sso/metadata', HTTP_IF_NONE_MATCH=etag))
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_modified(self):
+        response = self.view.get(self.factory.get('/api/sso/metadata', HTTP_IF_NONE_MATCH='"other"'))
+
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,6 @@
+from django.conf.urls import include, url
+
+urlpatterns = [
+    url(r'^(?P<tenant>[\w.-]+)/token/', include('token_auth.urls')),
+    url(r'^token/', include('token_auth.urls')),
+]
@@ -1,10 +1,46 @@
+import hashlib
+import json
+import threading
+from collections import Counter
+
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import cached_property
 from django.utils.module_loading import import_string
 
 from django.core.exceptions import ImproperlyConfigured
 
 
-def get_settings():
+class Counters(object):
+    """
+    Thread safe counters, for statistics.
+    """
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counts[name] += value
+
+    def get(self, name):
+        return self._counts[name]
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+def load_settings():
+    """
+    Resolve the TOKEN_AUTH settings dict. Use `get_settings()` instead, which
+    only does this once per process.
+    """
     properties_path = getattr(settings,
                               'TOKEN_AUTH_SETTINGS',
                               'django.conf.settings')
@@ -20,3 +56,114 @@ def get_settings():
         raise ImproperlyConfigured(
             'Missing TOKEN_AUTH attribute in {}'.format(properties_path)
         )
+
+
+def get_settings_hash(settings):
+    """
+    Digest of a settings dict, to key caches of objects derived from it.
+    """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=repr)).hexdigest()
+
+
+class TokenAuthConfig(object):
+    """
+    Resolved TOKEN_AUTH configuration.
+
+    Everything that can be derived from the settings alone (like the backend
+    class) is memoized on this object, so it is thrown away together with the
+    settings when they change.
+
+    Tenant configurations have the process wide configuration as `root`,
+    which holds the resources they share (like thread and process pools).
+    """
+    def __init__(self, settings, root=None):
+        self.settings = settings
+        self.root = root or self
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, default):
+        """
+        Return the object cached under `key`, calling `default` to create
+        it first if it is not cached yet.
+        """
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = default()
+            return self._cache[key]
+
+    @cached_property
+    def backend_class(self):
+        try:
+            backend = self.settings['backend']
+        except KeyError:
+            raise ImproperlyConfigured('TokenAuth backend not set')
+
+        try:
+            return import_string(backend)
+        except AttributeError:
+            raise ImproperlyConfigured(
+                'TokenAuth backend {} is not defined'.format(backend)
+            )
+
+    @cached_property
+    def settings_hash(self):
+        """
+        Digest of the settings, to key caches of objects derived from them.
+        """
+        return get_settings_hash(self.settings)
+
+    @cached_property
+    def token_store(self):
+        """
+        Store that keeps track of used tokens. Set with `token_store`.
+        """
+        return import_string(
+            self.settings.get('token_store', 'token_auth.stores.ModelTokenStore')
+        )(self.settings)
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config():
+    """
+    Return the process wide `TokenAuthConfig`. Concurrent first calls share
+    one config, so everything cached on it is created only once.
+    """
+    global _config
+
+    config = _config
+    if config is None:
+        with _config_lock:
+            if _config is None:
+                _config = TokenAuthConfig(load_settings())
+            config = _config
+    return config
+
+
+def reset_config():
+    """
+    Drop the cached configuration. It will be resolved again on next use.
+
+    This happens automatically when TOKEN_AUTH or TOKEN_AUTH_SETTINGS are
+    changed through Django's `setting_changed` signal (`override_settings`).
+    """
+    global _config
+    _config = None
+
+
+@receiver(setting_changed)
+def _reset_config_on_setting_changed(sender, setting, **kwargs):
+    if setting in ('TOKEN_AUTH', 'TOKEN_AUTH_SETTINGS'):
+        reset_config()
+
+
+def get_settings():
+    return get_config().settings
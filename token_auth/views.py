@@ -1,28 +1,29 @@
 import urllib
+from timeit import default_timer
 
+from django.core.urlresolvers import reverse
+from django.http import Http404
 from django.http.response import HttpResponseRedirect, HttpResponse
 from django.views.generic.base import View, TemplateView
-from django.utils.module_loading import import_string
-from django.core.exceptions import ImproperlyConfigured
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 
-from token_auth.exceptions import TokenAuthenticationError
-from token_auth.utils import get_settings
+from token_auth.audit import audit_login
+from token_auth.caches import get_rejected_tokens
+from token_auth.exceptions import TokenAuthenticationError, UnknownTenant
+from token_auth.tenants import get_request_config
 
 
-def get_auth(request, **kwargs):
-    settings = get_settings()
+def get_tenant_config(request, tenant=None):
     try:
-        backend = settings['backend']
-    except AttributeError:
-        raise ImproperlyConfigured('TokenAuth backend not set')
+        return get_request_config(request, tenant)
+    except UnknownTenant:
+        raise Http404('Unknown tenant')
 
-    try:
-        cls = import_string(backend)
-    except AttributeError:
-        raise ImproperlyConfigured(
-            'TokenAuth backend {} is not defined'.format(backend)
-        )
-    return cls(request, **kwargs)
+
+def get_auth(request, tenant=None, **kwargs):
+    config = get_tenant_config(request, tenant)
+    return config.backend_class(request, config=config, **kwargs)
 
 
 class TokenRedirectView(View):
@@ -43,15 +44,33 @@ class TokenLoginView(View):
     """
     Parse GET/POST request and login through set Authentication backend
     """
-    def get(self, request, link=None, token=None):
-        auth = get_auth(request, token=token, link=link)
+    def get(self, request, link=None, token=None, tenant=None):
+        start = default_timer()
+        config = get_tenant_config(request, tenant)
+
+        # Tokens that were rejected before are rejected again right away
+        rejected_tokens = get_rejected_tokens(config)
+        error = rejected_tokens.get(token) if token else None
+        if error:
+            audit_login(config, request, start, error=error)
+            return self.error_response(error, tenant)
+
+        auth = config.backend_class(request, config=config, token=token, link=link)
 
         try:
             user, created = auth.authenticate()
             user.backend = 'django.contrib.auth.backends.ModelBackend'
         except TokenAuthenticationError, e:
-            url = '/token/error?message={0}'.format(e)
-            return HttpResponseRedirect(url)
+            if token:
+                # Only remembered if retrying the token can not succeed
+                rejected_tokens.add(token, e)
+            audit_login(config, request, start, error=e)
+            return self.error_response(e, tenant)
+        except Exception, e:
+            audit_login(config, request, start, error=e)
+            raise
+
+        audit_login(config, request, start, user=user, created=created)
 
         url = "/login-with/{}/{}".format(user.pk, user.get_login_token())
 
@@ -64,6 +83,11 @@ class TokenLoginView(View):
 
     post = get
 
+    def error_response(self, error, tenant=None):
+        # The error page of the tenant, so it is shown with the tenant's settings
+        url = reverse('token-error', kwargs={'tenant': tenant}) if tenant else '/token/error'
+        return HttpResponseRedirect('{0}?message={1}'.format(url, error))
+
 
 class TokenLogoutView(TemplateView):
     """
@@ -114,5 +138,15 @@ class MetadataView(View):
 
     def get(self, request, *args, **kwargs):
         auth = get_auth(request, **kwargs)
-        metadata = auth.get_metadata()
-        return HttpResponse(content=metadata, content_type='text/xml')
+        metadata = auth.get_cached_metadata()
+
+        response = get_conditional_response(
+            request, etag=metadata.etag, last_modified=metadata.last_modified
+        )
+        if response is None:
+            response = HttpResponse(content=metadata.content, content_type='text/xml')
+
+        response['ETag'] = quote_etag(metadata.etag)
+        response['Last-Modified'] = http_date(metadata.last_modified)
+        patch_cache_control(response, public=True, max_age=auth.settings.get('metadata_max_age', 3600))
+        return response